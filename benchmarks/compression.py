@@ -0,0 +1,55 @@
+from kernelcollector import debfile
+import tempfile, time, sys, os
+
+# Each configuration is a codec, a compression level and a number of threads (0 means one per CPU core)
+CONFIGURATIONS = [
+    ('keep', None, 1),
+    ('gz', 6, 1),
+    ('gz', 9, 1),
+    ('xz', 6, 1),
+    ('xz', 6, 0),
+    ('xz', 9, 0),
+    ('zst', 3, 1),
+    ('zst', 3, 0),
+    ('zst', 10, 0),
+    ('zst', 19, 0)
+]
+
+def repack(source_filename, target_filename, codec, level, threads):
+    with debfile.DebFile(source_filename) as source:
+        control_files = source.read_control_files()
+
+        with open(target_filename, 'wb') as f:
+            writer = debfile.DebWriter(f)
+            writer.add_control_files(control_files)
+
+            if codec == 'keep':
+                writer.add_copied_data(source)
+            else:
+                writer.add_merged_data([source], codec, level, threads)
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 -m benchmarks.compression package.deb [package.deb...]')
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for source_filename in sys.argv[1:]:
+            source_size = os.path.getsize(source_filename)
+            print(f'{os.path.basename(source_filename)} ({source_size / 1048576:.2f} MiB)')
+            print(f'{"codec":<6}{"level":>6}{"threads":>8}{"seconds":>10}{"size (MiB)":>12}{"ratio":>8}')
+
+            for codec, level, threads in CONFIGURATIONS:
+                target_filename = os.path.join(tmp_dir, 'package.deb')
+                start = time.perf_counter()
+                repack(source_filename, target_filename, codec, level, threads)
+                elapsed = time.perf_counter() - start
+                size = os.path.getsize(target_filename)
+                level = '-' if level is None else level
+                threads = 'all' if threads == 0 else threads
+                print(f'{codec:<6}{level:>6}{threads:>8}{elapsed:>10.2f}{size / 1048576:>12.2f}{size / source_size:>8.3f}')
+
+            print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,499 @@
+from kernelcollector.package_collector import PackageCollector
+from kernelcollector.package_list import PackageList
+from kernelcollector.package_distribution import PackageDistribution
+from kernelcollector.webhook import WebhookEmitter
+from kernelcollector import compression, debfile, tracing
+import multiprocessing, http.server, subprocess, sys, functools, threading, argparse, resource, tempfile, tarfile, hashlib, logging, random, shutil, json, time, io, os
+
+ARCHITECTURES = ['amd64', 'arm64']
+
+# The upstream packages of every release: (architecture, kind, flavour, package architecture)
+# Both arm64 flavours end up in the same package, so their payloads are merged during the repack.
+UPSTREAM_PACKAGES = [
+    ('amd64', 'headers', '', 'all'),
+    ('amd64', 'headers', '-generic', 'amd64'), ('amd64', 'image-unsigned', '-generic', 'amd64'), ('amd64', 'modules', '-generic', 'amd64'),
+    ('amd64', 'headers', '-lowlatency', 'amd64'), ('amd64', 'image-unsigned', '-lowlatency', 'amd64'), ('amd64', 'modules', '-lowlatency', 'amd64'),
+    ('arm64', 'headers', '-generic', 'arm64'), ('arm64', 'image-unsigned', '-generic', 'arm64'), ('arm64', 'modules', '-generic', 'arm64'),
+    ('arm64', 'headers', '-generic-64k', 'arm64'), ('arm64', 'image-unsigned', '-generic-64k', 'arm64'), ('arm64', 'modules', '-generic-64k', 'arm64')
+]
+
+# Uncompressed payload size (MiB), file count and the share of incompressible data of every kind of package.
+# These roughly follow the mainline builds: the kernel image is already compressed, the headers are mostly text.
+PAYLOADS = {
+    'image-unsigned': (14, 4, 0.9),
+    'modules': (96, 6000, 0.4),
+    'headers': (24, 3000, 0.1),
+    'headers-all': (80, 20000, 0.1)
+}
+SOURCE_PAYLOAD = (48, 4000, 0.05)
+
+# Releases listed by the upstream stand-in: (link, package version)
+# The newest release of every channel is the one that gets downloaded.
+RELEASES = [
+    ('v6.11.1', '6.11.1-061101.202409301446'), ('v6.11.2', '6.11.2-061102.202410041240'), ('v6.11.3', '6.11.3-061103.202410101238'),
+    ('v6.12-rc1', '6.12.0-061200rc1.202409292137'), ('v6.12-rc2', '6.12.0-061200rc2.202410062229'), ('v6.12-rc3', '6.12.0-061200rc3.202410132237'),
+    ('daily/2024-10-14', '6.12.0-991200.202410140209'), ('daily/2024-10-15', '6.12.0-991200.202410150204'), ('daily/2024-10-16', '6.12.0-991200.202410160204')
+]
+STABLE_SOURCE = ('6.11.3', 'linux-6.11.3.tar.xz')
+MAINLINE_SOURCE = ('6.12-rc3', 'linux-6.12-rc3.tar.gz')
+
+LISTING_HEADER = '''<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">
+<html>
+ <head>
+  <title>Index of {path}</title>
+ </head>
+ <body>
+<h1>Index of {path}</h1>
+'''
+LISTING_TABLE = '''  <table>
+   <tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th><th><a href="?C=S;O=A">Size</a></th><th><a href="?C=D;O=A">Description</a></th></tr>
+   <tr><th colspan="5"><hr></th></tr>
+<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td><td><a href="{parent}">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td><td>&nbsp;</td></tr>
+'''
+LISTING_ROW = '<tr><td valign="top"><img src="/icons/folder.gif" alt="[DIR]"></td><td><a href="{name}">{name}</a></td><td align="right">2024-10-16 02:04  </td><td align="right">  - </td><td>&nbsp;</td></tr>\n'
+LISTING_FOOTER = '''   <tr><th colspan="5"><hr></th></tr>
+</table>
+</body></html>
+'''
+
+class UpstreamHandler(http.server.SimpleHTTPRequestHandler):
+    # Serves the upstream stand-in with the content types that the collector expects
+    extensions_map = dict(http.server.SimpleHTTPRequestHandler.extensions_map, **{'.deb': 'application/x-debian-package', '.xz': 'application/x-xz', '.gz': 'application/x-gzip'})
+
+    def log_message(self, *args):
+        pass
+
+class PayloadGenerator(object):
+    # Generates file contents with a chosen share of incompressible data
+
+    def __init__(self, seed):
+        rng = random.Random(seed)
+        self.random = rng.randbytes(4194304)
+        self.text = b''.join(f'{i:08x} {rng.choice(["static", "const", "struct", "return", "EXPORT_SYMBOL"])} entry_{i % 977};\n'.encode('ascii') for i in range(131072))
+        self.offset = 0
+
+    def get_data(self, size, randomness):
+        parts = []
+
+        while size > 0:
+            block = min(size, 65536)
+            random_size = int(block * randomness)
+
+            for corpus, length in ((self.random, random_size), (self.text, block - random_size)):
+                start = self.offset % (len(corpus) - length)
+                parts.append(corpus[start:start + length])
+
+            self.offset += 7919
+            size -= block
+
+        return b''.join(parts)
+
+def get_payload_files(kind, flavour, abi, scale):
+    # Returns the names and sizes of the files of a package
+    size, count, randomness = PAYLOADS['headers-all' if kind == 'headers' and not flavour else kind]
+    count = max(1, int(count * scale))
+    file_size = int(size * 1048576 * scale) // count
+
+    if kind == 'image-unsigned':
+        names = [f'boot/vmlinuz-{abi}{flavour}'] + [f'boot/extra-{i}-{abi}{flavour}' for i in range(1, count)]
+    elif kind == 'modules':
+        names = [f'lib/modules/{abi}{flavour}/kernel/drivers/group{i // 100}/module{i}.ko' for i in range(count)]
+    else:
+        names = [f'usr/src/linux-headers-{abi}{flavour}/include/group{i // 100}/header{i}.h' for i in range(count)]
+
+    return [(name, file_size) for name in names], randomness
+
+def serve_upstream(upstream_dir):
+    # Runs in its own process, so that the server doesn't show up in our measurements.
+    # The server is bound to a free port, which is handed back to the benchmark through our output.
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(UpstreamHandler, directory=upstream_dir))
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+def start_upstream_server(upstream_dir):
+    server_process = subprocess.Popen([sys.executable, '-m', 'benchmarks.e2e', '--serve', upstream_dir], stdout=subprocess.PIPE, text=True)
+    port = server_process.stdout.readline().strip()
+
+    if not port:
+        server_process.wait()
+        raise RuntimeError('The upstream server did not start.')
+
+    return server_process, f'http://127.0.0.1:{port}'
+
+def make_tar_info(name, size=0, mode=0o644, type=tarfile.REGTYPE):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = mode
+    info.type = type
+    info.mtime = 1728525000
+    return info
+
+def add_payload(tar, files, randomness, generator):
+    # Adds the files to a tar archive, alongside all of their parent directories.
+    # Returns the MD5 sums of the files, in the format of md5sums control files.
+    directories = set()
+    md5sums = []
+
+    for name, size in files:
+        parents = name.split('/')[:-1]
+
+        for i in range(1, len(parents) + 1):
+            directory = '/'.join(parents[:i])
+
+            if directory not in directories:
+                directories.add(directory)
+                tar.addfile(make_tar_info(f'./{directory}/', mode=0o755, type=tarfile.DIRTYPE))
+
+        data = generator.get_data(size, randomness)
+        tar.addfile(make_tar_info(f'./{name}', len(data)), io.BytesIO(data))
+        md5sums.append(f'{hashlib.md5(data).hexdigest()}  {name}\n')
+
+    return ''.join(md5sums)
+
+def make_deb(filename, arch, kind, flavour, pkg_arch, abi, version, scale, generator):
+    name = f'linux-{kind}-{abi}{flavour}'
+    files, randomness = get_payload_files(kind, flavour, abi, scale)
+    control = '\n'.join([
+        f'Package: {name}', f'Version: {version}', f'Architecture: {pkg_arch}', 'Maintainer: Benchmark <benchmark@localhost>',
+        f'Installed-Size: {sum(size for name, size in files) // 1024}', 'Depends: kmod, linux-base (>= 4.5ubuntu1~16.04.1), libc6 (>= 2.34)',
+        'Section: kernel', 'Priority: optional', f'Description: Synthetic {kind} package for benchmarking', ''
+    ]).encode('utf-8')
+    postrm = '\n'.join(['#!/bin/sh', 'set -e', 'version=' + abi + flavour, 'rm -f /lib/modules/$version/.fresh-install', 'exit 0', '']).encode('utf-8')
+
+    with open(filename, 'wb') as file, tempfile.TemporaryFile() as spool:
+        writer = compression.CompressedWriter(spool, 'zst', 3)
+
+        with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+            md5sums = add_payload(tar, files, randomness, generator).encode('utf-8')
+
+        writer.close()
+
+        control_files = {'control': [make_tar_info('./control'), control], 'md5sums': [make_tar_info('./md5sums'), md5sums]}
+
+        if kind == 'image-unsigned':
+            control_files['postrm'] = [make_tar_info('./postrm', mode=0o755), postrm]
+
+        deb = debfile.DebWriter(file)
+        deb.add_control_files(control_files)
+        size = spool.tell()
+        spool.seek(0)
+        deb.add_member_from_file('data.tar.zst', spool, size)
+
+def make_source_tarball(filename, mode, scale, generator):
+    size, count, randomness = SOURCE_PAYLOAD
+    count = max(1, int(count * scale))
+    file_size = int(size * 1048576 * scale) // count
+    files = [(f'linux/drivers/group{i // 100}/source{i}.c', file_size) for i in range(count)]
+    options = {'preset': 1} if mode == 'w:xz' else {'compresslevel': 1}
+
+    with tarfile.open(filename, mode, format=tarfile.GNU_FORMAT, **options) as tar:
+        add_payload(tar, files, randomness, generator)
+
+def write_page(filename, html):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    with open(filename, 'w') as file:
+        file.write(html)
+
+def make_listing(path, parent, names):
+    return LISTING_HEADER.format(path=path) + LISTING_TABLE.format(parent=parent) + ''.join(LISTING_ROW.format(name=name) for name in names) + LISTING_FOOTER
+
+def make_upstream(upstream_dir, base_url, scale):
+    # Creates the pages and files of kernel.org and the mainline builds
+    generator = PayloadGenerator(23)
+    debs_dir = os.path.join(upstream_dir, 'debs')
+    mainline_dir = os.path.join(upstream_dir, 'mainline')
+    sources_dir = os.path.join(upstream_dir, 'sources')
+    os.makedirs(debs_dir)
+    os.makedirs(sources_dir)
+
+    # Every release uses the same packages, only their names are different
+    debs = {}
+
+    for arch, kind, flavour, pkg_arch in UPSTREAM_PACKAGES:
+        filename = os.path.join(debs_dir, f'{arch}-{kind}{flavour}.deb')
+        make_deb(filename, arch, kind, flavour, pkg_arch, '6.11.3-061103', '6.11.3-061103.202410101238', scale, generator)
+        debs[(arch, kind, flavour)] = filename
+
+    for release_link, version in RELEASES:
+        abi = version.split('.2024')[0]
+        parts = [LISTING_HEADER.format(path=f'/mainline/{release_link}')]
+
+        for arch in ARCHITECTURES:
+            parts.append(f'<h2>Build for {arch} succeeded (see <a href="{arch}/log">{arch}/log</a>):</h2>\n')
+            os.makedirs(os.path.join(mainline_dir, release_link, arch))
+
+            for deb_arch, kind, flavour, pkg_arch in UPSTREAM_PACKAGES:
+                if deb_arch != arch:
+                    continue
+
+                name = f'{arch}/linux-{kind}-{abi}{flavour}_{version}_{pkg_arch}.deb'
+                os.link(debs[(arch, kind, flavour)], os.path.join(mainline_dir, release_link, name))
+                parts.append(f'  <a href="{name}">{name}</a><br>\n')
+
+            parts.append('<br>\n')
+
+        parts.append(LISTING_TABLE.format(parent='/mainline/'))
+        parts.extend(LISTING_ROW.format(name=f'{arch}/') for arch in ARCHITECTURES)
+        parts.append(LISTING_FOOTER)
+        write_page(os.path.join(mainline_dir, release_link, 'index.html'), ''.join(parts))
+
+    write_page(os.path.join(mainline_dir, 'index.html'), make_listing('/mainline', '/', [f'{link}/' for link, version in RELEASES if not link.startswith('daily/')] + ['daily/']))
+    write_page(os.path.join(mainline_dir, 'daily', 'index.html'), make_listing('/mainline/daily', '/mainline/', [f'{link[6:]}/' for link, version in RELEASES if link.startswith('daily/')] + ['current/']))
+
+    make_source_tarball(os.path.join(sources_dir, STABLE_SOURCE[1]), 'w:xz', scale, generator)
+    make_source_tarball(os.path.join(sources_dir, MAINLINE_SOURCE[1]), 'w:gz', scale, generator)
+
+    rows = []
+
+    for channel, (version, filename) in (('mainline', MAINLINE_SOURCE), ('stable', STABLE_SOURCE)):
+        rows.append(f'<tr align="left"><td>{channel}:</td><td><strong>{version}</strong></td><td>2024-10-13</td><td><a href="{base_url}/sources/{filename}" title="Download complete tarball">tarball</a></td></tr>\n')
+
+    write_page(os.path.join(upstream_dir, 'kernel.org', 'index.html'), '<html><body><table id="releases">\n' + ''.join(rows) + '</table></body></html>\n')
+
+def make_gpg_key(gnupg_dir):
+    # Creates a throwaway signing key, returns its fingerprint
+    os.makedirs(gnupg_dir, mode=0o700)
+    env = dict(os.environ, GNUPGHOME=gnupg_dir)
+    subprocess.run(['gpg', '--batch', '--passphrase', 'benchmark', '--quick-gen-key', 'KernelCollector Benchmark <benchmark@localhost>', 'ed25519', 'sign', 'never'], env=env, check=True, capture_output=True)
+    output = subprocess.run(['gpg', '--batch', '--list-keys', '--with-colons'], env=env, check=True, capture_output=True, text=True).stdout
+    return next(line.split(':')[9] for line in output.splitlines() if line.startswith('fpr:'))
+
+def read_written():
+    # Bytes handed to write() by this process
+    with open('/proc/self/io', 'r') as file:
+        return next(int(line.split()[1]) for line in file if line.startswith('wchar:'))
+
+def read_peak_rss():
+    with open('/proc/self/status', 'r') as file:
+        return next(int(line.split()[1]) * 1024 for line in file if line.startswith('VmHWM:'))
+
+def reset_peak_rss():
+    # Linux lets us reset the peak RSS of a process, so that it can be measured per stage
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+def get_cpu():
+    # CPU time of all threads of this process, and of all child processes that have finished (like gpg).
+    # Repack workers only finish once the pool is closed, so they don't show up in the stages that run alongside them.
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+def take_snapshot():
+    return time.monotonic(), get_cpu(), read_written()
+
+class Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0
+        self.cpu = 0
+        self.written = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def add(self, wall, cpu, written, peak, calls=1):
+        with self.lock:
+            self.calls += calls
+            self.wall += wall
+            self.cpu += cpu
+            self.written += written
+            self.peak = max(self.peak, peak)
+
+    def subtract(self, stage):
+        # Takes a nested stage out of this one
+        self.wall -= stage.wall
+        self.cpu -= stage.cpu
+        self.written -= stage.written
+
+class StageMeter(object):
+    # Wraps functions, so that the time and resources they use are attributed to a stage.
+    # Calls of the same stage that overlap (like parallel downloads) are measured together,
+    # from the moment the first one starts until the last one is done.
+
+    def __init__(self, record):
+        self.record = record
+        self.lock = threading.Lock()
+        self.active = 0
+        self.calls = 0
+        self.snapshot = None
+
+    def enter(self):
+        with self.lock:
+            if self.active == 0:
+                reset_peak_rss()
+                self.snapshot = take_snapshot()
+                self.calls = 0
+
+            self.active += 1
+            self.calls += 1
+
+    def exit(self):
+        with self.lock:
+            self.active -= 1
+
+            if self.active == 0:
+                wall, cpu, written = [end - start for start, end in zip(self.snapshot, take_snapshot())]
+                self.record(wall, cpu, written, read_peak_rss(), self.calls)
+
+    def wrap(self, function):
+        def wrapper(*args, **kwargs):
+            self.enter()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.exit()
+
+        return wrapper
+
+def record_to_file(metrics_dir):
+    # Repacks run in worker processes, they leave their measurements behind in files
+    def record(*values):
+        with open(os.path.join(metrics_dir, f'{os.getpid()}.jsonl'), 'a') as file:
+            file.write(json.dumps(values) + '\n')
+
+    return record
+
+def load_recorded(stage, metrics_dir):
+    for filename in os.listdir(metrics_dir):
+        with open(os.path.join(metrics_dir, filename), 'r') as file:
+            for line in file:
+                stage.add(*json.loads(line))
+
+        os.remove(os.path.join(metrics_dir, filename))
+
+def run_measured(collector, pkg_list, distribution, metrics_dir):
+    stages = {name: Stage(name) for name in ('scrape', 'download', 'repack', 'publish', 'sign')}
+    scrape = StageMeter(stages['scrape'].add)
+
+    # The measured functions are swapped out on the instances, and put back after the run
+    measured = [
+        (collector, 'get_kernel_releases', scrape), (collector, 'get_ubuntu_releases', scrape), (collector, 'get_daily_releases', scrape),
+        (collector, 'probe_releases', scrape), (collector, 'find_downloadable_files', scrape),
+        (collector, 'download_package', StageMeter(stages['download'].add)),
+        (collector, 'repack_package', StageMeter(record_to_file(metrics_dir))),
+        (pkg_list, 'save_all_distributions', StageMeter(stages['publish'].add)),
+        (distribution, 'sign_file', StageMeter(stages['sign'].add))
+    ]
+
+    for obj, method, meter in measured:
+        setattr(obj, method, meter.wrap(getattr(obj, method)))
+
+    total = Stage('total')
+    snapshot = take_snapshot()
+
+    try:
+        collector.run_all_builds()
+    finally:
+        for obj, method, meter in measured:
+            delattr(obj, method)
+
+    wall, cpu, written = [end - start for start, end in zip(snapshot, take_snapshot())]
+    peak = max(read_peak_rss(), resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+    load_recorded(stages['repack'], metrics_dir)
+    stages['publish'].subtract(stages['sign'])
+    # The repack workers have finished by now, so their CPU time is already part of ours
+    total.add(wall, cpu, sum(stage.written for stage in stages.values()), max([peak] + [stage.peak for stage in stages.values()]))
+    return list(stages.values()) + [total]
+
+def print_stages(title, stages):
+    print(title)
+    print(f'{"Stage":<12}{"Calls":>8}{"Wall (s)":>10}{"CPU (s)":>10}{"Peak RSS (MiB)":>16}{"Written (MiB)":>15}')
+
+    for stage in stages:
+        print(f'{stage.name:<12}{stage.calls:>8}{stage.wall:>10.2f}{stage.cpu:>10.2f}{stage.peak / 1048576:>16.1f}{stage.written / 1048576:>15.1f}')
+
+    print()
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the package collector end-to-end against a local stand-in of the upstream servers.')
+    parser.add_argument('--scale', type=float, default=1.0, help='scales the size of the generated packages and source tarballs')
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--repack-workers', type=int, default=None)
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory, for inspection')
+    parser.add_argument('--trace', metavar='FILE', help='write a timeline of the full run to this file, which can be opened in Perfetto')
+    parser.add_argument('--serve', metavar='DIRECTORY', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_upstream(args.serve)
+        return
+
+    # The measured methods are swapped out on the collector, which is handed to the repack workers as-is.
+    # That only works if the workers are forked: under forkserver or spawn, the wrappers would have to be pickled.
+    multiprocessing.set_start_method('fork')
+
+    work_dir = tempfile.mkdtemp(prefix='kernelcollector-e2e-')
+    upstream_dir = os.path.join(work_dir, 'upstream')
+    metrics_dir = os.path.join(work_dir, 'metrics')
+    current_dir = os.getcwd()
+    trace_file = os.path.abspath(args.trace) if args.trace else None
+    os.makedirs(metrics_dir)
+
+    if trace_file:
+        tracing.tracer.enable()
+
+    server_process = None
+
+    try:
+        # The server is started right away, so that we know which address to put into the pages
+        server_process, base_url = start_upstream_server(upstream_dir)
+        start = time.monotonic()
+        make_upstream(upstream_dir, base_url, args.scale)
+        os.environ['GNUPGHOME'] = os.path.join(work_dir, 'gnupg')
+        gpg_key = make_gpg_key(os.environ['GNUPGHOME'])
+        print(f'Generated upstream files in {time.monotonic() - start:.1f} seconds ({sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(os.path.join(upstream_dir, "debs")) for name in names) / 1048576:.1f} MiB of packages)')
+        print()
+
+        # The collector keeps its cache in the current directory
+        os.chdir(work_dir)
+
+        logger = WebhookEmitter(None)
+        pkg_list = PackageList(logger, os.path.join(work_dir, 'repo'), gpg_key, 'benchmark')
+        distribution = PackageDistribution(logger, 'sid', ARCHITECTURES, 'End-to-end benchmark')
+        pkg_list.add_distribution(distribution)
+
+        collector = PackageCollector(logger, ARCHITECTURES, pkg_list, args.download_workers, args.repack_workers)
+        collector.kernel_url = f'{base_url}/kernel.org/'
+        collector.mainline_url = f'{base_url}/mainline'
+        collector.tmp_dir = os.path.join(work_dir, 'tmp')
+        collector.download_dir = os.path.join(work_dir, 'downloads')
+
+        print_stages('Full run (everything is new)', run_measured(collector, pkg_list, distribution, metrics_dir))
+
+        if trace_file:
+            tracing.tracer.write(trace_file)
+            tracing.tracer.enabled = False
+
+        # Failures are only logged, so make sure that the run has actually published everything
+        packages = [name for root, dirs, names in os.walk(pkg_list.pool_folder) for name in names if name.endswith('.deb')]
+        sources = os.listdir(pkg_list.src_folder) if os.path.exists(pkg_list.src_folder) else []
+        print(f'Published {len(packages)} packages and {len(sources)} source archives.')
+        print()
+
+        print_stages('No-op run (nothing has changed)', run_measured(collector, pkg_list, distribution, metrics_dir))
+    finally:
+        os.chdir(current_dir)
+
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+        if os.environ.get('GNUPGHOME', '').startswith(work_dir):
+            subprocess.run(['gpgconf', '--kill', 'gpg-agent'], capture_output=True)
+
+        if args.keep:
+            print(f'Kept {work_dir}')
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p')
+    logging.root.setLevel(logging.WARNING)
+    main()
@@ -0,0 +1,70 @@
+from kernelcollector import hashing
+import tempfile, hashlib, time, sys, os
+
+# Sizes of the generated sample files, in MiB
+SAMPLE_SIZES = [1, 8, 64, 256]
+SAMPLE_COUNT = 4
+
+def legacy_hash_file(filename):
+    # The previous implementation: 64 KiB reads, all digests updated one after another
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+
+    with open(filename, 'rb') as file:
+        while True:
+            data = file.read(65536)
+
+            if not data:
+                break
+
+            md5.update(data)
+            sha1.update(data)
+            sha256.update(data)
+
+    return md5.hexdigest(), sha1.hexdigest(), sha256.hexdigest()
+
+def measure(name, total_size, function):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<40}{elapsed:>10.3f}{total_size / 1048576 / elapsed:>12.1f}')
+    return result
+
+def create_samples(tmp_dir):
+    filenames = []
+
+    for size in SAMPLE_SIZES:
+        for i in range(SAMPLE_COUNT):
+            filename = os.path.join(tmp_dir, f'{size}_{i}.bin')
+
+            with open(filename, 'wb') as file:
+                file.write(os.urandom(size * 1048576))
+
+            filenames.append(filename)
+
+    return filenames
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Either hash the files we were given, or generate a few samples
+        filenames = sys.argv[1:] or create_samples(tmp_dir)
+        total_size = sum(os.path.getsize(filename) for filename in filenames)
+
+        # Warm up the page cache, so that we measure hashing rather than the disk
+        for filename in filenames:
+            legacy_hash_file(filename)
+
+        print(f'Hashing {len(filenames)} files ({total_size / 1048576:.1f} MiB)')
+        print(f'{"implementation":<40}{"seconds":>10}{"MiB/s":>12}')
+
+        expected = measure('legacy (64 KiB reads, serial)', total_size, lambda: {filename: legacy_hash_file(filename) for filename in filenames})
+        result = measure('hash_file (mmap, concurrent digests)', total_size, lambda: {filename: hashing.hash_file(filename) for filename in filenames})
+        assert result == expected
+
+        for workers in sorted({1, 2, hashing.HASH_WORKERS, os.cpu_count() or 1}):
+            result = measure(f'hash_files ({workers} workers)', total_size, lambda: hashing.hash_files(filenames, workers))
+            assert result == expected
+
+if __name__ == '__main__':
+    main()
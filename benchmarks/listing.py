@@ -0,0 +1,137 @@
+from kernelcollector.package_collector import PackageCollector, PAGE_CHUNK_SIZE
+from kernelcollector import utils
+from bs4 import BeautifulSoup
+import gzip, time, os
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+RUNS = 10
+
+# The previous implementations, which build a whole BeautifulSoup tree for every page
+
+def legacy_parse_ubuntu_releases(data):
+    soup = BeautifulSoup(data, 'html.parser')
+    prereleases = []
+    releases = []
+
+    for row in soup.find_all('tr'):
+        tds = row.find_all('td')
+
+        if len(tds) != 5:
+            continue
+
+        a = tds[1].find('a')
+
+        if not a:
+            continue
+
+        name = a.text
+        prerelease = '-rc' in name
+
+        if len(name) < 2 or name[0] != 'v' or (not name[1].isdigit()) or ('-' in name and not prerelease) or (name.count('-') > 1):
+            continue
+
+        name = name.rstrip('/')
+
+        if prerelease:
+            prereleases.append(name)
+        else:
+            releases.append(name)
+
+    prereleases.sort(key=lambda x: utils.release_to_tuple(x), reverse=True)
+    releases.sort(key=lambda x: utils.release_to_tuple(x), reverse=True)
+
+    if utils.release_to_tuple(releases[-1])[0:2] >= utils.release_to_tuple(prereleases[-1])[0:2]:
+        prereleases.append(releases[-1])
+
+    return [releases, prereleases]
+
+def legacy_parse_daily_releases(data):
+    soup = BeautifulSoup(data, 'html.parser')
+    versions = []
+
+    for row in soup.find_all('tr'):
+        tds = row.find_all('td')
+
+        if len(tds) != 5:
+            continue
+
+        a = tds[1].find('a')
+
+        if a and a['href'] == a.text:
+            version = a.text.rstrip('/')
+
+            if version != 'current':
+                versions.append(version)
+
+    return sorted(versions, reverse=True)
+
+def legacy_parse_files(data):
+    files = []
+    soup = BeautifulSoup(data, 'html.parser')
+    arch = None
+
+    for a in soup.find_all('a'):
+        text = a.text
+
+        if text.endswith('/log'):
+            arch = text[:text.find('/log')]
+            continue
+        elif text == 'Name':
+            break
+        elif not text.endswith('.deb') or not arch:
+            continue
+        elif '-lpae' in text:
+            continue
+
+        files.append([arch, text])
+
+    return files
+
+class ChunkCounter(object):
+    # Splits a page up into chunks, just like a download would, and counts how much of it has been handed out
+
+    def __init__(self, data):
+        self.data = data
+        self.consumed = 0
+
+    def __iter__(self):
+        for i in range(0, len(self.data), PAGE_CHUNK_SIZE):
+            chunk = self.data[i:i+PAGE_CHUNK_SIZE]
+            self.consumed += len(chunk)
+            yield chunk
+
+def measure(function, *args):
+    timings = []
+
+    for i in range(RUNS):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), result
+
+def main():
+    collector = PackageCollector(None, ['amd64', 'arm64', 'armhf', 'ppc64el', 's390x'], None)
+    pages = [
+        ('mainline.html.gz', legacy_parse_ubuntu_releases, collector.parse_ubuntu_releases),
+        ('daily.html.gz', legacy_parse_daily_releases, collector.parse_daily_releases),
+        ('release.html.gz', legacy_parse_files, collector.parse_files)
+    ]
+
+    print(f'{"Page":<20}{"Size (KiB)":>12}{"Parsed (KiB)":>14}{"BeautifulSoup (ms)":>20}{"Streaming (ms)":>16}{"Match":>8}')
+
+    for name, legacy_parser, parser in pages:
+        with gzip.open(os.path.join(FIXTURES_DIR, name), 'rb') as file:
+            data = file.read()
+
+        legacy_time, expected = measure(legacy_parser, data)
+        stream_time, result = measure(lambda: parser(ChunkCounter(data)))
+
+        # How much of the page the streaming parser had to look at before it was done
+        counter = ChunkCounter(data)
+        parser(counter)
+
+        print(f'{name:<20}{len(data) / 1024:>12.1f}{counter.consumed / 1024:>14.1f}{legacy_time * 1000:>20.1f}{stream_time * 1000:>16.1f}{"yes" if result == expected else "NO":>8}')
+
+if __name__ == '__main__':
+    main()
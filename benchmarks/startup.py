@@ -0,0 +1,50 @@
+import subprocess, tempfile, json, time, sys, os
+
+RUNS = 10
+
+# Dependencies that are only loaded once we talk to a server, or once something has changed upstream
+HEAVY_MODULES = ['bs4', 'deb_pkg_tools', 'gnupg', 'looseversion', 'requests', 'zstandard']
+
+SCENARIOS = [
+    ('Interpreter only', 'pass'),
+    ('Import kernelcollector.main', 'import kernelcollector.main'),
+    ('Construct Main', 'from kernelcollector.main import Main; Main()'),
+    ('Construct Main, eager imports', 'from kernelcollector.main import Main; Main(); import bs4, deb_pkg_tools.package, deb_pkg_tools.control, deb_pkg_tools.deb822, looseversion, gnupg; gnupg.GPG()')
+]
+
+def run_python(code, cwd):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], cwd=cwd, env=env, check=True, capture_output=True, text=True).stdout
+    return time.perf_counter() - start, output
+
+def measure(name, code, cwd):
+    # Every run starts a fresh interpreter, so nothing is cached in memory between runs
+    timings = sorted(run_python(code, cwd)[0] for i in range(RUNS))
+    print(f'{name:<40}{timings[0] * 1000:>12.1f}{timings[len(timings) // 2] * 1000:>12.1f}')
+
+def get_loaded_modules(cwd):
+    code = f'import sys; from kernelcollector.main import Main; Main(); print(" ".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    return run_python(code, cwd)[1].split()
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        settings = {'repoPath': os.path.join(tmp_dir, 'repo'), 'gpgKey': 'ABCDEF', 'gpgPassword': 'none', 'distribution': 'sid', 'description': 'Startup benchmark', 'architectures': ['amd64'], 'webhook': None}
+
+        with open(os.path.join(tmp_dir, 'settings.json'), 'w') as file:
+            json.dump(settings, file)
+
+        # Fills in the tuning values, so that every measured run is a regular one
+        run_python('from kernelcollector.main import Main; Main()', tmp_dir)
+
+        print(f'{"Scenario":<40}{"Best (ms)":>12}{"Median (ms)":>12}')
+
+        for name, code in SCENARIOS:
+            measure(name, code, tmp_dir)
+
+        loaded = get_loaded_modules(tmp_dir)
+        print()
+        print(f'Heavy modules loaded before the first fetch: {", ".join(loaded) if loaded else "none"}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import struct, zlib, lzma, os
+
+# Maps the codec names used in our settings to the extensions used by .deb members
+CODEC_EXTENSIONS = {'gzip': 'gz', 'xz': 'xz', 'zstd': 'zst'}
+DEFAULT_LEVELS = {'gz': 9, 'xz': 6, 'zst': 3}
+
+# The dictionary sizes used by the xz presets, as defined by liblzma
+XZ_PRESET_DICT_SIZES = [1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22, 1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26]
+XZ_HEADER_MAGIC = b'\xfd7zXZ\x00'
+XZ_FOOTER_MAGIC = b'YZ'
+XZ_STREAM_FLAGS = b'\x00\x01' # CRC32 checks
+XZ_FILTER_LZMA2 = 0x21
+
+# The most uncompressed data that may wait for (or be in) the xz compression threads at once
+XZ_MAX_PENDING_BYTES = 1 << 27
+
+class CompressionException(Exception):
+    pass
+
+def get_thread_count(threads):
+    # Zero threads means one thread per CPU core
+    return threads or os.cpu_count() or 1
+
+def xz_varint(value):
+    data = bytearray()
+
+    while value >= 0x80:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    data.append(value)
+    return bytes(data)
+
+def xz_padding(size):
+    return b'\x00' * (-size % 4)
+
+def xz_crc32(data):
+    return struct.pack('<I', zlib.crc32(data))
+
+def xz_compress_block(data, preset, dict_size):
+    # Compresses a single, self-contained xz block.
+    # Both the compressed and the uncompressed size are stored in the block header,
+    # so that decompressors can hand out the blocks to multiple threads.
+    filters = [{'id': lzma.FILTER_LZMA2, 'preset': preset, 'dict_size': dict_size}]
+    compressed = lzma.compress(data, format=lzma.FORMAT_RAW, filters=filters)
+
+    # The LZMA2 dictionary size is encoded as a single byte, our dictionary sizes are always powers of two
+    dict_property = 2 * (dict_size.bit_length() - 1 - 12)
+    header = bytes([0x40 | 0x80]) + xz_varint(len(compressed)) + xz_varint(len(data))
+    header += xz_varint(XZ_FILTER_LZMA2) + xz_varint(1) + bytes([dict_property])
+
+    header_size = 1 + len(header) + 4
+    header_size += -header_size % 4
+    header = bytes([header_size // 4 - 1]) + header
+    header += xz_padding(len(header))
+    header += xz_crc32(header)
+
+    block = header + compressed + xz_padding(len(header) + len(compressed)) + xz_crc32(data)
+    unpadded_size = len(header) + len(compressed) + 4
+    return block, unpadded_size, len(data)
+
+class ParallelXZWriter(object):
+    # Writes a valid multi-block .xz stream.
+    # Blocks are compressed independently on a thread pool (liblzma releases the GIL while compressing).
+
+    def __init__(self, fileobj, preset=6, threads=0, block_size=None, max_pending_bytes=XZ_MAX_PENDING_BYTES):
+        self.fileobj = fileobj
+        self.preset = preset
+        self.threads = get_thread_count(threads)
+        self.dict_size = XZ_PRESET_DICT_SIZES[preset]
+        self.block_size = block_size or max(self.dict_size * 3, 1 << 20)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.max_pending_bytes = max_pending_bytes
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.buffer = bytearray()
+        self.records = []
+
+        # The dictionary does not have to be larger than the block itself
+        while self.dict_size > (1 << 12) and self.dict_size // 2 >= self.block_size:
+            self.dict_size //= 2
+
+        self.fileobj.write(XZ_HEADER_MAGIC + XZ_STREAM_FLAGS + xz_crc32(XZ_STREAM_FLAGS))
+
+    def write(self, data):
+        self.buffer += data
+
+        while len(self.buffer) >= self.block_size:
+            self.submit_block(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+    def submit_block(self, data):
+        self.pending.append(self.executor.submit(xz_compress_block, data, self.preset, self.dict_size))
+        self.pending_bytes += len(data)
+
+        # Don't let too many blocks pile up in memory, no matter how many threads we have
+        while self.pending and self.pending_bytes > self.max_pending_bytes:
+            self.write_block()
+
+    def write_block(self):
+        block, unpadded_size, uncompressed_size = self.pending.popleft().result()
+        self.pending_bytes -= uncompressed_size
+        self.fileobj.write(block)
+        self.records.append((unpadded_size, uncompressed_size))
+
+    def abort(self):
+        # Throws away all blocks that haven't been written yet
+        if self.executor is None:
+            return
+
+        self.executor.shutdown(cancel_futures=True)
+        self.executor = None
+
+    def close(self):
+        if self.executor is None:
+            return
+
+        if self.buffer:
+            self.submit_block(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        while self.pending:
+            self.write_block()
+
+        self.executor.shutdown()
+        self.executor = None
+
+        index = b'\x00' + xz_varint(len(self.records))
+
+        for unpadded_size, uncompressed_size in self.records:
+            index += xz_varint(unpadded_size) + xz_varint(uncompressed_size)
+
+        index += xz_padding(len(index))
+        index += xz_crc32(index)
+
+        backward_size = struct.pack('<I', len(index) // 4 - 1)
+        footer = xz_crc32(backward_size + XZ_STREAM_FLAGS) + backward_size + XZ_STREAM_FLAGS + XZ_FOOTER_MAGIC
+        self.fileobj.write(index + footer)
+
+class CompressedWriter(object):
+
+    def __init__(self, fileobj, compression, level=None, threads=1):
+        self.fileobj = fileobj
+        self.compression = compression
+        level = DEFAULT_LEVELS.get(compression, None) if level is None else level
+
+        if compression == '':
+            self.compressor = None
+        elif compression == 'gz':
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compression == 'xz' and threads != 1:
+            self.compressor = None
+            self.fileobj = ParallelXZWriter(fileobj, level, threads)
+        elif compression == 'xz':
+            self.compressor = lzma.LZMACompressor(lzma.FORMAT_XZ, preset=level)
+        elif compression == 'zst':
+            # zstandard uses -1 to refer to all CPU cores, and 0 for no worker threads at all
+            import zstandard
+            zstd_threads = -1 if threads == 0 else (0 if threads == 1 else threads)
+            self.compressor = zstandard.ZstdCompressor(level=level, threads=zstd_threads).compressobj()
+        else:
+            raise CompressionException(f'Unsupported compression: {compression}')
+
+    def write(self, data):
+        if self.compressor is None:
+            self.fileobj.write(data)
+            return
+
+        data = self.compressor.compress(data)
+
+        if data:
+            self.fileobj.write(data)
+
+    def close(self):
+        if isinstance(self.fileobj, ParallelXZWriter):
+            self.fileobj.close()
+        elif self.compressor is not None:
+            self.fileobj.write(self.compressor.flush())
+            self.compressor = None
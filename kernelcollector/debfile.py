@@ -0,0 +1,290 @@
+from .compression import CompressedWriter
+import tarfile, tempfile, time, lzma, bz2, gzip, io, os
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+DEBIAN_BINARY = b'2.0\n'
+COPY_BUFFER_SIZE = 1048576
+
+class DebFormatException(Exception):
+    pass
+
+def normalize_name(name):
+    # Tar entries might be called ./lib/modules/ or lib/modules, these are the same
+    name = name.rstrip('/')
+
+    if name.startswith('./'):
+        name = name[2:]
+
+    return name or '.'
+
+def get_compression(member_name):
+    # control.tar.gz -> gz, data.tar -> (no compression)
+    parts = member_name.split('.')
+    return parts[2] if len(parts) > 2 else ''
+
+def get_member_name(prefix, compression):
+    return f'{prefix}.{compression}' if compression else prefix
+
+def open_decompressor(fileobj, compression):
+    if compression == '':
+        return fileobj
+    elif compression == 'gz':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif compression in ('xz', 'lzma'):
+        return lzma.LZMAFile(fileobj, mode='rb')
+    elif compression == 'bz2':
+        return bz2.BZ2File(fileobj, mode='rb')
+    elif compression == 'zst':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+    raise DebFormatException(f'Unsupported compression: {compression}')
+
+class ArMemberReader(io.RawIOBase):
+
+    def __init__(self, fileobj, offset, size):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+
+        if size <= 0:
+            return 0
+
+        self.fileobj.seek(self.offset)
+        data = self.fileobj.read(size)
+        buffer[:len(data)] = data
+        self.offset += len(data)
+        self.remaining -= len(data)
+        return len(data)
+
+class TeeReader(io.RawIOBase):
+    # Copies everything that is read from a raw reader to another file
+
+    def __init__(self, raw, fileobj):
+        self.raw = raw
+        self.fileobj = fileobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.raw.readinto(buffer)
+
+        if size:
+            self.fileobj.write(bytes(buffer[:size]))
+
+        return size
+
+class ArMember(object):
+
+    def __init__(self, fileobj, name, offset, size):
+        self.fileobj = fileobj
+        self.name = name
+        self.offset = offset
+        self.size = size
+
+    @property
+    def compression(self):
+        return get_compression(self.name)
+
+    def open(self):
+        return io.BufferedReader(ArMemberReader(self.fileobj, self.offset, self.size), COPY_BUFFER_SIZE)
+
+    def open_tee(self, fileobj):
+        return io.BufferedReader(TeeReader(ArMemberReader(self.fileobj, self.offset, self.size), fileobj), COPY_BUFFER_SIZE)
+
+    def open_tar(self):
+        # Tar members are read as a stream, we never have to seek back
+        return tarfile.open(fileobj=open_decompressor(self.open(), self.compression), mode='r|')
+
+class DebFile(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fileobj = open(filename, 'rb')
+        self.members = []
+
+        try:
+            self.read_members()
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.fileobj.close()
+
+    def read_members(self):
+        if self.fileobj.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise DebFormatException(f'{self.filename} is not a Debian package.')
+
+        offset = len(AR_MAGIC)
+
+        while True:
+            self.fileobj.seek(offset)
+            header = self.fileobj.read(AR_HEADER_SIZE)
+
+            if not header:
+                break
+
+            if len(header) != AR_HEADER_SIZE or header[58:60] != b'`\n':
+                raise DebFormatException(f'{self.filename} has a corrupted archive header.')
+
+            # GNU ar terminates names with a slash
+            name = header[0:16].decode('ascii').rstrip(' ').rstrip('/')
+            size = int(header[48:58].decode('ascii'))
+            offset += AR_HEADER_SIZE
+            self.members.append(ArMember(self.fileobj, name, offset, size))
+
+            # Members are aligned to even offsets
+            offset += size + (size % 2)
+
+        if not self.members or self.members[0].name != 'debian-binary':
+            raise DebFormatException(f'{self.filename} is missing its debian-binary member.')
+
+    def get_member(self, prefix):
+        for member in self.members:
+            if member.name.startswith(prefix):
+                return member
+
+        raise DebFormatException(f'{self.filename} has no {prefix} member.')
+
+    def read_control_files(self):
+        # The control member is tiny, so we simply read it into memory.
+        # Returns a dictionary of file name -> [tar info, file contents]
+        files = {}
+
+        with self.get_member('control.tar').open_tar() as tar:
+            for info in tar:
+                data = tar.extractfile(info).read() if info.isfile() else None
+                files[normalize_name(info.name)] = [info, data]
+
+        return files
+
+    def get_contents(self):
+        # Returns the names of all files in the package
+        return [normalize_name(info.name) for info, data in self.iter_data() if not info.isdir()]
+
+    def iter_data(self):
+        # Yields all entries of the data member, alongside a file object for regular files.
+        # The file object is only valid until the next entry is requested.
+        with self.get_member('data.tar').open_tar() as tar:
+            for info in tar:
+                yield info, tar.extractfile(info) if info.isfile() else None
+
+class DebWriter(object):
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.fileobj.write(AR_MAGIC)
+        self.add_member('debian-binary', DEBIAN_BINARY)
+
+    def write_member_header(self, name, size):
+        header = f'{name:<16}{int(time.time()):<12}{0:<6}{0:<6}{"100644":<8}{size:<10}`\n'
+        self.fileobj.write(header.encode('ascii'))
+
+    def write_member_padding(self, size):
+        if size % 2:
+            self.fileobj.write(b'\n')
+
+    def add_member(self, name, data):
+        self.write_member_header(name, len(data))
+        self.fileobj.write(data)
+        self.write_member_padding(len(data))
+
+    def add_member_from_file(self, name, fileobj, size):
+        self.write_member_header(name, size)
+        remaining = size
+
+        while remaining > 0:
+            data = fileobj.read(min(remaining, COPY_BUFFER_SIZE))
+
+            if not data:
+                raise DebFormatException(f'Unexpected end of file while writing {name}.')
+
+            self.fileobj.write(data)
+            remaining -= len(data)
+
+        self.write_member_padding(size)
+
+    def add_control_files(self, files, compression='gz'):
+        buffer = io.BytesIO()
+        writer = CompressedWriter(buffer, compression)
+
+        with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+            for info, data in files.values():
+                if data is None:
+                    tar.addfile(info)
+                else:
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+
+        writer.close()
+        self.add_member(get_member_name('control.tar', compression), buffer.getvalue())
+
+    def add_copied_data(self, source):
+        # Copy the data member of another package byte-for-byte, without recompressing it.
+        # While it's being copied, the member is also decompressed, so that we learn which files it contains.
+        # Returns the names of all files in the package.
+        member = source.get_member('data.tar')
+        contents = []
+
+        self.write_member_header(member.name, member.size)
+        reader = member.open_tee(self.fileobj)
+
+        with tarfile.open(fileobj=open_decompressor(reader, member.compression), mode='r|') as tar:
+            for info in tar:
+                if not info.isdir():
+                    contents.append(normalize_name(info.name))
+
+        # Copy whatever the decompressor didn't need to read
+        while reader.read(COPY_BUFFER_SIZE):
+            pass
+
+        self.write_member_padding(member.size)
+        return contents
+
+    def add_merged_data(self, sources, compression='gz', level=None, threads=1):
+        # Merge the data members of multiple packages into one.
+        # Just like when extracting the packages on top of each other, later packages win,
+        # so we go through them backwards and skip everything we've already seen.
+        # The size of the compressed member has to be known in advance, so it is spooled to disk first.
+        # Returns the names of all files in the package.
+        seen = set()
+        contents = []
+
+        with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.fileobj.name))) as spool:
+            writer = CompressedWriter(spool, compression, level, threads)
+
+            with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                for source in reversed(sources):
+                    for info, data in source.iter_data():
+                        name = normalize_name(info.name)
+
+                        if name in seen:
+                            continue
+
+                        seen.add(name)
+                        tar.addfile(info, data)
+
+                        if not info.isdir():
+                            contents.append(name)
+
+            writer.close()
+            size = spool.tell()
+            spool.seek(0)
+            self.add_member_from_file(get_member_name('data.tar', compression), spool, size)
+
+        return contents
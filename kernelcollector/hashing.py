@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib, mmap, os
+
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha256')
+
+# Files smaller than this are read in one go and hashed on the calling thread,
+# spinning up threads for them would cost more than it saves.
+PARALLEL_THRESHOLD = 1048576
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+
+def update_hash(hash, data):
+    # hashlib releases the GIL while hashing large buffers, so these calls run concurrently
+    hash.update(data)
+    return hash.hexdigest()
+
+def hash_file(filename):
+    # Returns the MD5, SHA1 and SHA256 hashes of a file.
+    # Large files are memory-mapped, and all three digests are computed at the same time on separate threads.
+    hashes = [hashlib.new(algorithm) for algorithm in HASH_ALGORITHMS]
+
+    with open(filename, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+
+        if size < PARALLEL_THRESHOLD:
+            data = file.read()
+            return tuple(update_hash(hash, data) for hash in hashes)
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # The whole file is going to be read sequentially
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+
+            with ThreadPoolExecutor(max_workers=len(hashes)) as executor:
+                return tuple(executor.map(update_hash, hashes, [data] * len(hashes)))
+
+def hash_files(filenames, workers=HASH_WORKERS):
+    # Hashes many files at once with a bounded number of workers.
+    # Returns a dictionary of filename -> (MD5, SHA1, SHA256)
+    filenames = list(filenames)
+
+    if len(filenames) <= 1 or workers <= 1:
+        return {filename: hash_file(filename) for filename in filenames}
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(filenames))) as executor:
+        return dict(zip(filenames, executor.map(hash_file, filenames)))
@@ -0,0 +1,86 @@
+from html.parser import HTMLParser
+from collections import namedtuple
+import codecs
+
+# A link of a directory listing.
+# Links inside of a table row know the column they're in (starting from 0) and the amount of columns in their row,
+# links outside of tables have no column.
+Link = namedtuple('Link', ['name', 'href', 'column', 'columns'])
+
+class ListingParser(HTMLParser):
+    # Parses Apache-style directory listings as they are being downloaded, without building a document tree.
+    # Links outside of tables are available as soon as they're closed.
+    # Links inside of a table row are held back until the row is over, because only then do we know how wide the row is.
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+        self.row = None
+        self.column = None
+        self.columns = 0
+        self.link = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.end_link()
+            self.link = [dict(attrs).get('href'), self.column, []]
+        elif tag == 'tr':
+            self.end_row()
+            self.row = []
+        elif tag == 'td' and self.row is not None:
+            self.column = self.columns
+            self.columns += 1
+
+    def handle_endtag(self, tag):
+        if tag == 'a':
+            self.end_link()
+        elif tag == 'td':
+            self.column = None
+        elif tag in ('tr', 'table'):
+            self.end_row()
+
+    def handle_data(self, data):
+        if self.link is not None:
+            self.link[2].append(data)
+
+    def end_link(self):
+        if self.link is None:
+            return
+
+        href, column, text = self.link
+        self.link = None
+
+        if self.row is None:
+            self.links.append(Link(''.join(text), href, None, 0))
+        else:
+            self.row.append([''.join(text), href, column])
+
+    def end_row(self):
+        if self.row is None:
+            return
+
+        self.end_link()
+        self.links.extend(Link(name, href, column, self.columns) for name, href, column in self.row)
+        self.row = None
+        self.column = None
+        self.columns = 0
+
+    def pop_links(self):
+        links = self.links
+        self.links = []
+        return links
+
+def iter_links(chunks, encoding='utf-8'):
+    # Yields the links of a listing while it's being downloaded.
+    # Once the caller stops iterating, no more data is parsed.
+    parser = ListingParser()
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+
+    for chunk in chunks:
+        parser.feed(decoder.decode(chunk))
+        yield from parser.pop_links()
+
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    parser.end_row()
+    yield from parser.pop_links()
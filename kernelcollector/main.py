@@ -2,7 +2,8 @@ from .package_collector import PackageCollector
 from .package_list import PackageList
 from .package_distribution import PackageDistribution
 from .webhook import WebhookEmitter
-import traceback, json, logging, os, sys
+from . import metrics, tracing, utils
+import traceback, argparse, json, logging, random, signal, time, os, sys
 
 class Main(object):
 
@@ -12,37 +13,126 @@ class Main(object):
                 self.settings = json.load(file)
 
         default_values = {'repoPath': '/srv/packages', 'gpgKey': 'ABCDEF', 'gpgPassword': 'none', 'distribution': 'sid', 'description': 'Package repository for newest Linux kernels', 'architectures': ['amd64'], 'webhook': None}
+        tuning_values = {'downloadWorkers': 4, 'repackWorkers': None, 'repackQueueSize': 2, 'probeDepth': 3, 'probeWorkers': 6, 'httpTimeout': [10, 60], 'httpConnections': 8, 'httpRetries': 3, 'pdiffHistory': 30, 'byHashGracePeriod': 86400, 'daemonInterval': 600, 'daemonJitter': 60, 'metricsFile': None, 'metricsPort': None, 'sourceCompressionThreads': 2,
+            'compression': {pkg_type: {'codec': 'gzip', 'level': None, 'threads': 1} for pkg_type in ('image', 'modules', 'headers')}
+        }
         edited = False
+        tuned = False
 
         for key, value in default_values.items():
             if key not in self.settings:
                 self.settings[key] = value
                 edited = True
 
+        # The workers setting has been split up into download and repack workers
+        if 'workers' in self.settings:
+            workers = self.settings.pop('workers')
+            tuned = True
+
+            if workers is not None:
+                self.settings.setdefault('downloadWorkers', workers)
+                self.settings.setdefault('repackWorkers', workers)
+
+            logging.info(f'The workers setting is deprecated, it has been replaced by downloadWorkers ({self.settings.get("downloadWorkers", tuning_values["downloadWorkers"])}) and repackWorkers ({self.settings.get("repackWorkers", tuning_values["repackWorkers"])}).')
+
+        # Tuning values have sensible defaults, so they can be filled in without user intervention
+        for key, value in tuning_values.items():
+            if key not in self.settings:
+                self.settings[key] = value
+                tuned = True
+
         if edited:
             print('Please edit the settings.json file before running the package collector!')
             self.save_settings()
             sys.exit()
 
+        if tuned:
+            self.save_settings()
+
+        utils.configure_http(self.settings['httpTimeout'], self.settings['httpConnections'], self.settings['httpRetries'])
         self.logger = WebhookEmitter(self.settings['webhook'])
 
         self.package_list = PackageList(self.logger, self.settings['repoPath'].rstrip('/'), self.settings['gpgKey'], self.settings['gpgPassword'])
-        self.package_dist = PackageDistribution(self.logger, self.settings['distribution'], self.settings['architectures'], self.settings['description'])
+        self.package_dist = PackageDistribution(self.logger, self.settings['distribution'], self.settings['architectures'], self.settings['description'], self.settings['pdiffHistory'], self.settings['byHashGracePeriod'])
         self.package_list.add_distribution(self.package_dist)
 
-        self.package_collector = PackageCollector(self.logger, self.settings['architectures'], self.package_list)
+        self.package_collector = PackageCollector(self.logger, self.settings['architectures'], self.package_list, self.settings['downloadWorkers'], self.settings['repackWorkers'], self.settings['repackQueueSize'], self.settings['probeDepth'], self.settings['probeWorkers'], self.settings['compression'], self.settings['sourceCompressionThreads'])
+        self.trace_file = None
 
     def run_all_builds(self):
         # Attempt to run all builds.
         # If something goes wrong, a webhook message will be sent.
+        start = time.monotonic()
+        result = 'success'
 
         try:
-            self.package_collector.run_all_builds()
+            with tracing.tracer.span('run'):
+                self.package_collector.run_all_builds()
         except:
+            result = 'failure'
             self.logger.add('Something went wrong while building packages!', alert=True)
             self.logger.add(traceback.format_exc(), pre=True)
             self.logger.send_all()
 
+        duration = time.monotonic() - start
+        metrics.RUNS.inc(result=result)
+        metrics.RUN_DURATION.observe(duration)
+        metrics.LAST_RUN_DURATION.set(duration)
+        metrics.LAST_RUN.set(time.time())
+
+        if result == 'success':
+            metrics.LAST_SUCCESS.set(time.time())
+
+        self.write_metrics()
+        self.write_trace()
+
+    def write_metrics(self):
+        # Metrics are written for the textfile collector of the node exporter
+        if not self.settings['metricsFile']:
+            return
+
+        try:
+            metrics.registry.write_textfile(self.settings['metricsFile'])
+        except:
+            logging.info(f'Could not write metrics to {self.settings["metricsFile"]}!')
+            logging.info(traceback.format_exc())
+
+    def write_trace(self):
+        # Every run gets a fresh trace, which replaces the trace of the previous run
+        if not self.trace_file:
+            return
+
+        try:
+            tracing.tracer.write(self.trace_file)
+        except:
+            logging.info(f'Could not write trace to {self.trace_file}!')
+            logging.info(traceback.format_exc())
+
+    def run_daemon(self):
+        # Keep running builds until we're asked to stop.
+        # Our caches, the pool index and the HTTP connections all stay in memory between runs.
+        stop_event = self.package_collector.stop_event
+
+        def stop(signum, frame):
+            logging.info('Shutting down after the current run...')
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        # Metrics can also be scraped directly while we keep running
+        if self.settings['metricsPort']:
+            metrics.registry.serve(self.settings['metricsPort'])
+            logging.info(f'Serving metrics on port {self.settings["metricsPort"]}.')
+
+        while not stop_event.is_set():
+            self.run_all_builds()
+
+            # Spread out our requests a little, in case multiple instances are running
+            delay = self.settings['daemonInterval'] + random.uniform(0, self.settings['daemonJitter'])
+            logging.info(f'Next run in {delay:.0f} seconds.')
+            stop_event.wait(delay)
+
     def save_settings(self):
         with open('settings.json', 'w') as file:
             json.dump(self.settings, file, sort_keys=True, indent=4, separators=(',', ': '))
@@ -51,5 +141,20 @@ if __name__ == '__main__':
     logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p')
     logging.root.setLevel(logging.INFO)
 
+    parser = argparse.ArgumentParser(description='Keeps a Debian package repository of the newest Linux kernels up to date.')
+    parser.add_argument('--daemon', action='store_true', help='keep running and check for new kernels periodically')
+    parser.add_argument('--trace', metavar='FILE', help='write a timeline of every run to this file, which can be opened in Perfetto')
+    args = parser.parse_args()
+
     main = Main()
-    main.run_all_builds()
+
+    if args.trace:
+        main.trace_file = args.trace
+        tracing.tracer.enable()
+
+    if args.daemon:
+        main.run_daemon()
+    else:
+        main.run_all_builds()
+
+    main.logger.close()
@@ -0,0 +1,207 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading, math, time, os
+
+DURATION_BUCKETS = [0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+THROUGHPUT_BUCKETS = [1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9]
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')) for name, value in labels]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class Metric(object):
+    type = None
+
+    def __init__(self, registry, name, description, label_names):
+        self.registry = registry
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def get_key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} expects the labels {", ".join(self.label_names)}')
+
+        return tuple((name, labels[name]) for name in self.label_names)
+
+    def get_lines(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+
+        for key, value in sorted(self.values.items()):
+            lines.extend(self.get_sample_lines(key, value))
+
+        return lines
+
+    def get_sample_lines(self, key, value):
+        return [f'{self.name}{format_labels(key)} {format_value(value)}']
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.registry.update(self.name, self.get_key(labels), amount)
+
+    def apply(self, key, amount):
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.registry.update(self.name, self.get_key(labels), value)
+
+    def apply(self, key, value):
+        self.values[key] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, description, label_names, buckets):
+        super().__init__(registry, name, description, label_names)
+        self.buckets = list(buckets) + [math.inf]
+
+    def observe(self, value, **labels):
+        self.registry.update(self.name, self.get_key(labels), value)
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def apply(self, key, value):
+        # Every sample is [bucket counts..., sum]
+        sample = self.values.setdefault(key, [0] * len(self.buckets) + [0])
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                sample[i] += 1
+
+        sample[-1] += value
+
+    def get_sample_lines(self, key, sample):
+        lines = [f'{self.name}_bucket{format_labels(key + (("le", format_value(bound)),))} {count}' for bound, count in zip(self.buckets, sample)]
+        lines.append(f'{self.name}_sum{format_labels(key)} {format_value(sample[-1])}')
+        lines.append(f'{self.name}_count{format_labels(key)} {sample[-2]}')
+        return lines
+
+class Timer(object):
+    # Observes the time spent inside of a with block
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.forward_queue = None
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, label_names=()):
+        return self.add(Counter(self, name, description, label_names))
+
+    def gauge(self, name, description, label_names=()):
+        return self.add(Gauge(self, name, description, label_names))
+
+    def histogram(self, name, description, label_names=(), buckets=DURATION_BUCKETS):
+        return self.add(Histogram(self, name, description, label_names, buckets))
+
+    def update(self, name, key, value):
+        # Worker processes hand their updates over to the main process, which exports them
+        if self.forward_queue is not None:
+            self.forward_queue.put((name, key, value))
+            return
+
+        with self.lock:
+            self.metrics[name].apply(key, value)
+
+    def forward_to(self, forward_queue):
+        # Used by worker processes: the lock might have been held by another thread while forking
+        self.lock = threading.Lock()
+        self.forward_queue = forward_queue
+
+    def receive(self, forward_queue):
+        for name, key, value in iter(forward_queue.get, None):
+            with self.lock:
+                self.metrics[name].apply(key, value)
+
+    def start_receiver(self, forward_queue):
+        receiver = threading.Thread(target=self.receive, args=(forward_queue,), daemon=True)
+        receiver.start()
+        return receiver
+
+    def get_text(self):
+        # Returns all metrics in the Prometheus text exposition format
+        with self.lock:
+            lines = [line for metric in self.metrics.values() for line in metric.get_lines()]
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filename):
+        # The node exporter might read the file at any time, so it is replaced in one go
+        tmp_filename = f'{filename}.tmp'
+
+        with open(tmp_filename, 'w') as file:
+            file.write(self.get_text())
+
+        os.replace(tmp_filename, filename)
+
+    def serve(self, port, address=''):
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                data = registry.get_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+registry = MetricsRegistry()
+
+RUNS = registry.counter('kernelcollector_runs_total', 'Collector runs, by result.', ['result'])
+RUN_DURATION = registry.histogram('kernelcollector_run_duration_seconds', 'Duration of collector runs.')
+LAST_RUN = registry.gauge('kernelcollector_last_run_timestamp_seconds', 'Time at which the last run has finished.')
+LAST_SUCCESS = registry.gauge('kernelcollector_last_success_timestamp_seconds', 'Time at which the last successful run has finished.')
+LAST_RUN_DURATION = registry.gauge('kernelcollector_last_run_duration_seconds', 'Duration of the last run.')
+STAGE_DURATION = registry.histogram('kernelcollector_stage_duration_seconds', 'Duration of the stages of a run: scrape, build, inspect, index and sign.', ['stage'])
+PACKAGE_DURATION = registry.histogram('kernelcollector_package_duration_seconds', 'Time spent downloading and repacking a single package.', ['stage'])
+PACKAGES = registry.counter('kernelcollector_packages_total', 'Packages, by result: repacked, failed, or skipped because they were already up to date.', ['result'])
+PAGE_FETCHES = registry.counter('kernelcollector_page_fetches_total', 'Upstream index pages, by result: modified or not_modified.', ['result'])
+DOWNLOADS = registry.counter('kernelcollector_downloads_total', 'File downloads, by result.', ['result'])
+DOWNLOAD_BYTES = registry.counter('kernelcollector_download_bytes_total', 'Bytes received by file downloads.')
+DOWNLOAD_THROUGHPUT = registry.histogram('kernelcollector_download_throughput_bytes_per_second', 'Throughput of single file downloads, each of which runs on its own worker.', buckets=THROUGHPUT_BUCKETS)
+POOL_INSPECTIONS = registry.counter('kernelcollector_pool_inspections_total', 'Pool packages, by result: cached if their metadata came from the pool index, inspected otherwise.', ['result'])
+POOL_PACKAGES = registry.gauge('kernelcollector_pool_packages', 'Packages that are currently published.')
+INDEX_FILES = registry.counter('kernelcollector_index_files_total', 'Index files, by result: written or unchanged.', ['result'])
+INDEX_BYTES = registry.counter('kernelcollector_index_bytes_written_total', 'Bytes written to index files.')
@@ -1,51 +1,114 @@
-from bs4 import BeautifulSoup
-from . import utils
-import json, logging, tempfile, re, shutil, os, uuid, multiprocessing, traceback
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from . import compression, debfile, listing, metrics, tracing, utils
+import hashlib, json, logging, tempfile, re, shutil, time, os, uuid, multiprocessing, threading, queue, signal, traceback
 
 FIND_IMAGE_RM = 'rm -f /lib/modules/$version/.fresh-install'
 NEW_FIND_IMAGE_RM = 'rm -rf /lib/modules/$version'
 INITRD_IMAGE_RMS = ['rm -f /boot/initrd.img-$version', 'rm -f /var/lib/initramfs-tools/$version']
 DEB_CONTENT_TYPE = 'application/x-debian-package'
 DAILY_RELEASE_REGEX = re.compile(r'\d{4}-\d{2}-\d{2}')
+DEFAULT_COMPRESSION_POLICY = {'codec': 'gzip', 'level': None, 'threads': 1}
+PAGE_CHUNK_SIZE = 65536
+KERNEL_URL = 'https://kernel.org'
+MAINLINE_URL = 'https://kernel.ubuntu.com/mainline'
+
+# The collector used by the repack worker processes.
+# It is handed over once, when the worker process starts, instead of being pickled for every package.
+repack_collector = None
+
+def init_repack_worker(collector, log_queue, metrics_queue, trace_queue):
+    global repack_collector
+    repack_collector = collector
+
+    # Shutting down is up to the main process, the pool has to be able to terminate its workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Messages and metrics of the worker are sent by the main process
+    repack_collector.logger.forward_to(log_queue)
+    metrics.registry.forward_to(metrics_queue)
+
+    if trace_queue is not None:
+        tracing.tracer.forward_to(trace_queue, multiprocessing.current_process().name)
+
+def parse_html(data):
+    # BeautifulSoup is only needed when an upstream page has actually changed
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(data, 'html.parser')
+
+def repack_package_worker(release_name, release_type, pkg_name, deb_filenames):
+    with metrics.PACKAGE_DURATION.time(stage='repack'), tracing.tracer.span('repack', package=pkg_name):
+        return repack_collector.repack_package(release_name, release_type, pkg_name, deb_filenames)
 
 class PackageCollector(object):
 
-    def __init__(self, logger, architectures, pkg_list):
+    def __init__(self, logger, architectures, pkg_list, download_workers=4, repack_workers=None, repack_queue_size=2, probe_depth=3, probe_workers=6, compression_policy=None, source_compression_threads=2):
         self.logger = logger
         self.architectures = architectures
         self.pkg_list = pkg_list
+        self.download_workers = download_workers
+        self.repack_workers = repack_workers or multiprocessing.cpu_count()
+        self.repack_queue_size = repack_queue_size
+        self.probe_depth = probe_depth
+        self.probe_workers = probe_workers
+        self.compression_policy = compression_policy or {}
+        self.source_compression_threads = source_compression_threads
         self.tmp_dir = os.path.join(tempfile.gettempdir(), uuid.uuid4().hex)
         self.current_dir = os.getcwd()
+
+        # Partial downloads are kept between runs, and pruned at the start of every run.
+        # Every collector (with its own settings and cache in its own directory) gets its own download folder.
+        self.download_dir = os.path.join(tempfile.gettempdir(), f'kernelcollector-downloads-{hashlib.sha1(self.current_dir.encode("utf-8")).hexdigest()[:16]}')
+        self.stop_event = threading.Event()
+
+        # Where we look for new releases, these can be pointed elsewhere (for example, at a mirror)
+        self.kernel_url = KERNEL_URL
+        self.mainline_url = MAINLINE_URL
         self.reload_cache()
 
+    def __getstate__(self):
+        # The repack workers receive a copy of the collector. Shutting down is up to the main process,
+        # so the stop event (which can't be pickled) stays here.
+        state = self.__dict__.copy()
+        state['stop_event'] = None
+        return state
+
     def run_all_builds(self):
         # Get all releases and prereleases
         logging.info(f'Current directory is {self.current_dir}')
-        logging.info('Checking latest source versions of the kernel...')
+        self.used_pages = set()
+        scrape_start = time.monotonic()
 
-        stable_name, stable_link, mainline_name, mainline_link = self.get_kernel_releases()
-        logging.info(f'Current source release: v{stable_name}')
-        logging.info(f'Current source release candidate: v{mainline_name}')
+        with tracing.tracer.span('scrape'):
+            logging.info('Checking latest source versions of the kernel...')
 
-        logging.info('Checking latest binary versions of the kernel...')
+            stable_name, stable_link, mainline_name, mainline_link = self.get_kernel_releases()
+            logging.info(f'Current source release: v{stable_name}')
+            logging.info(f'Current source release candidate: v{mainline_name}')
 
-        releases, prereleases = self.get_ubuntu_releases()
-        daily_releases = self.get_daily_releases()
-        downloaded = False
+            logging.info('Checking latest binary versions of the kernel...')
 
-        # Delete the temporary folder
-        if os.path.exists(self.tmp_dir):
-            shutil.rmtree(self.tmp_dir)
+            releases, prereleases = self.get_ubuntu_releases()
+            daily_releases = self.get_daily_releases()
+            downloaded = False
+
+            # Delete the temporary folder
+            if os.path.exists(self.tmp_dir):
+                shutil.rmtree(self.tmp_dir)
+
+            # Fetch the file lists of the newest releases of every channel at the same time
+            probed_files = self.probe_releases([(releases, 'linux-current'), (prereleases, 'linux-beta'), (daily_releases, 'linux-devel')])
 
-        # Redownload stable build if necessary
-        release, downloadable_release = self.find_downloadable_files(releases, 'linux-current')
-        prerelease, downloadable_prerelease = self.find_downloadable_files(prereleases, 'linux-beta')
-        daily_release, downloadable_daily_release = self.find_downloadable_files(daily_releases, 'linux-devel')
-        downloadable_stable = self.find_downloadable_sources('linux-stable', stable_name, stable_link)
-        downloadable_mainline = self.find_downloadable_sources('linux-mainline', mainline_name, mainline_link)
+            # Redownload stable build if necessary
+            release, downloadable_release = self.find_downloadable_files(releases, 'linux-current', probed_files)
+            prerelease, downloadable_prerelease = self.find_downloadable_files(prereleases, 'linux-beta', probed_files)
+            daily_release, downloadable_daily_release = self.find_downloadable_files(daily_releases, 'linux-devel', probed_files)
+            downloadable_stable = self.find_downloadable_sources('linux-stable', stable_name, stable_link)
+            downloadable_mainline = self.find_downloadable_sources('linux-mainline', mainline_name, mainline_link)
 
-        downloadable = downloadable_release + downloadable_prerelease + downloadable_daily_release + downloadable_stable + downloadable_mainline
+            downloadable = downloadable_release + downloadable_prerelease + downloadable_daily_release + downloadable_stable + downloadable_mainline
+
+        metrics.STAGE_DURATION.observe(time.monotonic() - scrape_start, stage='scrape')
 
         logging.info(f'Current binary release: {release}')
         logging.info(f'Current binary release candidate: {prerelease}')
@@ -53,41 +116,143 @@ class PackageCollector(object):
 
         self.logger.send_all()
 
+        # Remember the validators of the upstream pages, even if there's nothing new to download
+        if self.cache_changed:
+            self.update_cache()
+
         # Update cache and publish repository
         if not downloadable:
             return
 
         # Create the temporary folder
         os.makedirs(self.tmp_dir)
-
-        # Schedule pool
-        downloadable_queue = utils.split_list(downloadable, multiprocessing.cpu_count())
-        downloadable_queue = [q for q in downloadable_queue if q]
-        worker_count = len(downloadable_queue)
-
-        # Create and run the pool
-        pool = multiprocessing.Pool(processes=worker_count)
-        file_caches = pool.map(self.download_files_worker, list(enumerate(downloadable_queue)))
-        downloaded = any(file_caches)
-
-        # Update the global file cache from the multiprocessing pool
-        for cache in file_caches:
-            self.file_cache.update(cache)
+        self.pkg_list.clear_staging()
+
+        # Partial downloads are kept between runs, so that they can be resumed
+        self.prune_downloads(downloadable)
+
+        # Downloads and repacks run as two separate stages.
+        # Download threads feed downloaded packages into the repack process pool.
+        # The repack queue is bounded, so downloads pause while the repack workers are busy.
+        download_count = min(self.download_workers, len(downloadable))
+        repack_count = min(self.repack_workers, len(downloadable))
+        repack_slots = threading.BoundedSemaphore(repack_count + self.repack_queue_size)
+        results = queue.Queue()
+
+        logging.info(f'Starting {download_count} download workers and {repack_count} repack workers with {len(downloadable)} packages to download...')
+
+        # Messages, metrics and trace events of the repack workers are forwarded to our own logger, metrics and tracer
+        log_queue = multiprocessing.Queue()
+        metrics_queue = multiprocessing.Queue()
+        trace_queue = multiprocessing.Queue() if tracing.tracer.enabled else None
+        build_start = time.monotonic()
+
+        with tracing.tracer.span('build', packages=len(downloadable)):
+            # The repack pool has to be created before any other threads are started
+            with multiprocessing.Pool(processes=repack_count, initializer=init_repack_worker, initargs=(self, log_queue, metrics_queue, trace_queue)) as pool:
+                receiver = self.logger.start_receiver(log_queue)
+                metrics_receiver = metrics.registry.start_receiver(metrics_queue)
+                trace_receiver = tracing.tracer.start_receiver(trace_queue) if trace_queue is not None else None
+
+                with ThreadPoolExecutor(max_workers=download_count) as executor:
+                    for package in downloadable:
+                        executor.submit(self.download_package_worker, pool, repack_slots, results, package)
+
+                    # Results are streamed back as soon as each package is finished.
+                    for i in range(len(downloadable)):
+                        # This is where we idle while the downloads and repacks are running
+                        with tracing.tracer.span('wait for results'):
+                            pkg_name, filenames, success, staged = results.get()
+
+                        if not success:
+                            # This package will be retried during the next run
+                            logging.info(f'Failed package {pkg_name} ({i + 1}/{len(downloadable)})')
+                            metrics.PACKAGES.inc(result='failed')
+                            continue
+
+                        # The pool and its index are only ever touched by this process
+                        if staged is not None:
+                            with tracing.tracer.span('add to pool', package=pkg_name):
+                                self.pkg_list.add_deb_to_pool(*staged)
+
+                        logging.info(f'Finished package {pkg_name} ({i + 1}/{len(downloadable)})')
+                        metrics.PACKAGES.inc(result='repacked')
+
+                        # Update the global file cache
+                        self.file_cache[pkg_name] = filenames
+                        downloaded = True
+
+                # Let the workers exit on their own, so that all of their messages make it through
+                pool.close()
+                pool.join()
+
+            log_queue.put(None)
+            metrics_queue.put(None)
+            receiver.join()
+            metrics_receiver.join()
+
+            if trace_queue is not None:
+                trace_queue.put(None)
+                trace_receiver.join()
+
+        metrics.STAGE_DURATION.observe(time.monotonic() - build_start, stage='build')
 
         # Update the cache if necessary
         if downloaded:
             self.update_cache()
-            self.publish_repository()
+
+            with tracing.tracer.span('publish'):
+                self.publish_repository()
 
         # Remove temporary folder
         if os.path.exists(self.tmp_dir):
             shutil.rmtree(self.tmp_dir)
 
+    def fetch_page(self, url, parser):
+        # Fetch an upstream index page and parse it.
+        # The validators of every page are kept in our cache, alongside the parsed result.
+        # If the page has not changed since the last time, the server replies with a 304 and we can reuse the parsed result.
+        pages = self.cache.setdefault('pages', {})
+        page = pages.get(url, None)
+        headers = {}
+
+        if page:
+            if page.get('etag'):
+                headers['If-None-Match'] = page['etag']
+            if page.get('lastModified'):
+                headers['If-Modified-Since'] = page['lastModified']
+
+        with tracing.tracer.span('fetch page', url=url), utils.http_get(url, headers=headers, stream=True) as site:
+            self.used_pages.add(url)
+
+            if site.status_code == 304 and page:
+                metrics.PAGE_FETCHES.inc(result='not_modified')
+                return page['data']
+
+            metrics.PAGE_FETCHES.inc(result='modified')
+
+            # The page is parsed while it's being downloaded
+            chunks = site.iter_content(PAGE_CHUNK_SIZE)
+            data = parser(chunks)
+
+            # The parser might have stopped early. Read the rest of the page, so that the connection can be reused
+            for chunk in chunks:
+                pass
+
+            if site.status_code == 200 and (site.headers.get('ETag') or site.headers.get('Last-Modified')):
+                pages[url] = {'etag': site.headers.get('ETag'), 'lastModified': site.headers.get('Last-Modified'), 'data': data}
+            else:
+                pages.pop(url, None)
+
+            self.cache_changed = True
+
+        return data
+
     def get_kernel_releases(self):
-        with requests.get('https://kernel.org') as site:
-            data = site.content
+        return tuple(self.fetch_page(self.kernel_url, self.parse_kernel_releases))
 
-        soup = BeautifulSoup(data, 'html.parser')
+    def parse_kernel_releases(self, chunks):
+        soup = parse_html(b''.join(chunks))
         table_rows = soup.find_all('tr')
         mainline_entry = next((row for row in table_rows if 'mainline' in row.text), None)
         stable_entry = next((row for row in table_rows if 'stable' in row.text), None)
@@ -111,32 +276,26 @@ class PackageCollector(object):
         mainline_version_tuple = utils.release_to_tuple(mainline_version)[0:2]
 
         if stable_version_tuple < mainline_version_tuple and '-rc' not in mainline_version:
-            return mainline_version, mainline_download_link, mainline_version, mainline_download_link
+            return [mainline_version, mainline_download_link, mainline_version, mainline_download_link]
 
-        return stable_version, stable_download_link, mainline_version, mainline_download_link
+        return [stable_version, stable_download_link, mainline_version, mainline_download_link]
 
     def get_ubuntu_releases(self):
         # We use the Ubuntu kernel mainline as the build source.
         # This method will return a list of releases and prereleases, sorted in ascending order.
-        with requests.get('https://kernel.ubuntu.com/mainline') as site:
-            data = site.content
+        releases, prereleases = self.fetch_page(self.mainline_url, self.parse_ubuntu_releases)
+        return releases, prereleases
 
-        soup = BeautifulSoup(data, 'html.parser')
+    def parse_ubuntu_releases(self, chunks):
         prereleases = []
         releases = []
 
-        for row in soup.findAll('tr'):
-            tds = row.findAll('td')
-
-            if len(tds) != 5:
-                continue
-
-            a = tds[1].find('a')
-
-            if not a:
+        for link in listing.iter_links(chunks):
+            # Every release has its own row, with the link in the second of five columns
+            if link.columns != 5 or link.column != 1:
                 continue
 
-            name = a.text
+            name = link.name
             prerelease = '-rc' in name
 
             # Some Ubuntu specific kernel versions will have to be skipped, for example 2.6.32-xenial
@@ -160,27 +319,22 @@ class PackageCollector(object):
         if utils.release_to_tuple(releases[-1])[0:2] >= utils.release_to_tuple(prereleases[-1])[0:2]:
             prereleases.append(releases[-1])
 
-        return releases, prereleases
+        return [releases, prereleases]
 
     def get_daily_releases(self):
         # We have to find the newest daily release version
-        with requests.get('https://kernel.ubuntu.com/mainline/daily') as site:
-            data = site.content
+        return self.fetch_page(f'{self.mainline_url}/daily', self.parse_daily_releases)
 
-        soup = BeautifulSoup(data, 'html.parser')
+    def parse_daily_releases(self, chunks):
         versions = []
 
-        for row in soup.findAll('tr'):
-            tds = row.findAll('td')
-
-            if len(tds) != 5:
+        for link in listing.iter_links(chunks):
+            if link.columns != 5 or link.column != 1:
                 continue
 
-            a = tds[1].find('a')
-
             # The link encapsulated inside the <a> tag and the text of the tag will match for daily releases
-            if a and a['href'] == a.text:
-                version = a.text.rstrip('/')
+            if link.href == link.name:
+                version = link.name.rstrip('/')
 
                 if version != 'current':
                     versions.append(version)
@@ -188,31 +342,12 @@ class PackageCollector(object):
         return sorted(versions, reverse=True)
 
     def get_files(self, release_link, release_type):
-        with requests.get(f'https://kernel.ubuntu.com/mainline/{release_link}') as site:
-            data = site.content
-
         files = {}
-        soup = BeautifulSoup(data, 'html.parser')
-        arch = None
-
-        for a in soup.findAll('a'):
-            text = a.text
 
-            # We have multiple options.
-            # If we've reached a build log, that means that we've switched to a new architecture.
-            # If we've reached MainlineBuilds, then we're done with all architectures.
-            # If we have a chosen architecture and the file is a .deb package, then it has to be in
-            # our list of architectures and it must not be an lpae-based build (we don't package those)
-            if text.endswith('/log'):
-                arch = text[:text.find('/log')]
-                continue
-            elif text == 'Name':
-                break
-            elif not text.endswith('.deb') or not arch:
-                continue
-            elif arch not in self.architectures:
-                continue
-            elif '-lpae' in text:
+        # The parsed page does not depend on our settings, so it can be cached as-is.
+        for arch, text in self.fetch_page(f'{self.mainline_url}/{release_link}', self.parse_files):
+            # The file has to be in our list of architectures
+            if arch not in self.architectures:
                 continue
 
             found_current = False
@@ -243,15 +378,42 @@ class PackageCollector(object):
 
         return files
 
+    def parse_files(self, chunks):
+        files = []
+        arch = None
+
+        for link in listing.iter_links(chunks):
+            text = link.name
+
+            # We have multiple options.
+            # If we've reached a build log, that means that we've switched to a new architecture.
+            # If we've reached MainlineBuilds, then we're done with all architectures.
+            # If we have a chosen architecture and the file is a .deb package,
+            # it must not be an lpae-based build (we don't package those)
+            if text.endswith('/log'):
+                arch = text[:text.find('/log')]
+                continue
+            elif text == 'Name':
+                break
+            elif not text.endswith('.deb') or not arch:
+                continue
+            elif '-lpae' in text:
+                continue
+
+            files.append([arch, text])
+
+        return files
+
     def download_and_repack_source(self, release_link, release_name, release_type):
         archive_name = f'{release_type}.tar.xz'
         temp_filename = os.path.join(self.tmp_dir, archive_name)
+        download_filename = os.path.join(self.download_dir, f'{release_type}.src')
         archive_filename = os.path.join(self.pkg_list.src_folder, archive_name)
 
         logging.info(f'Downloading source for release {release_name} from {release_link}')
 
         try:
-            utils.download_file_to_xz(release_link, temp_filename)
+            utils.download_file_to_xz(release_link, temp_filename, download_filename, self.source_compression_threads)
         except:
             self.logger.add(f'Could not download {archive_name} from {release_link}!', alert=True)
             self.logger.add(traceback.format_exc(), pre=True)
@@ -264,38 +426,36 @@ class PackageCollector(object):
         if os.path.exists(archive_filename):
             os.remove(archive_filename)
 
-        shutil.copyfile(temp_filename, archive_filename)
-        os.remove(temp_filename)
+        utils.move_file(temp_filename, archive_filename)
+        return True
 
-    def download_and_repack(self, release_link, release_name, release_type, pkg_name, filenames):
-        if release_type in ('linux-stable', 'linux-mainline'):
-            return self.download_and_repack_source(release_link, release_name, release_type)
+    def get_package_version(self, release_name, release_type):
+        # Kernel versions such as 5.0 have to be adjusted to 5.0.0
+        if release_type == 'linux-devel':
+            return release_name
 
-        deb_filename = os.path.join(self.tmp_dir, pkg_name + '.deb')
-        extract_folder = os.path.join(self.tmp_dir, uuid.uuid4().hex)
-        control_filename = os.path.join(extract_folder, 'DEBIAN', 'control')
-        postrm_filename = os.path.join(extract_folder, 'DEBIAN', 'postrm')
+        names = release_name.split('-')
+        release = list(utils.release_to_tuple(names[0]))
 
-        # Create a temporary folder for the repackaging
-        if os.path.exists(extract_folder):
-            shutil.rmtree(extract_folder)
+        while len(release) < 3:
+            release.append(0)
 
-        os.makedirs(extract_folder)
+        names[0] = '.'.join([str(num) for num in release])
+        return '-'.join(names)
 
-        # Kernel versions such as 5.0 have to be adjusted to 5.0.0
-        if release_type != 'linux-devel':
-            names = release_name.split('-')
-            release = list(utils.release_to_tuple(names[0]))
-
-            while len(release) < 3:
-                release.append(0)
+    def download_package(self, release_link, release_name, release_type, pkg_name, filenames):
+        # This is the first (network-bound) stage of the pipeline.
+        # Returns the list of downloaded .deb files, or None if the download has failed.
+        # Sources have nothing to repack, so they return an empty list instead.
+        if release_type in ('linux-stable', 'linux-mainline'):
+            return [] if self.download_and_repack_source(release_link, release_name, release_type) else None
 
-            names[0] = '.'.join([str(num) for num in release])
-            release_name = '-'.join(names)
+        deb_filenames = []
 
         for i, filename in enumerate(filenames):
-            primary_file = i == 0
-            link = f'https://kernel.ubuntu.com/mainline/{release_link}/{filename}'
+            # The same upstream file might be downloaded for multiple channels at once
+            deb_filename = os.path.join(self.download_dir, f'{pkg_name}_{i}.deb')
+            link = f'{self.mainline_url}/{release_link}/{filename}'
 
             # Download the .deb
             logging.info(f'Downloading package {pkg_name} (release v{release_name}) from {link}')
@@ -306,53 +466,14 @@ class PackageCollector(object):
                 self.logger.add(f'Could not download {os.path.basename(deb_filename)} from {link}!', alert=True)
                 self.logger.add(traceback.format_exc(), pre=True)
                 self.logger.send_all()
-                return
-
-            # Extract the .deb file
-            extract_flag = '-R' if primary_file else '-x'
-            result = utils.run_process(['dpkg-deb', extract_flag, deb_filename, extract_folder])
-
-            if result.failed:
-                self.logger.add(f'Could not extract {os.path.basename(deb_filename)} (error code {result.exit_code})!', alert=True)
-                self.logger.add(result.get_output(), pre=True)
-                self.logger.send_all()
-                return
-
-            if not primary_file:
-                # Auxiliary packages: unpack metadata into a secondary folder
-                aux_extract_folder = os.path.join(self.tmp_dir, uuid.uuid4().hex)
-
-                if os.path.exists(aux_extract_folder):
-                    shutil.rmtree(aux_extract_folder)
-
-                os.makedirs(aux_extract_folder)
-                result = utils.run_process(['dpkg-deb', '-e', deb_filename, aux_extract_folder])
-
-                if result.failed:
-                    self.logger.add(f'Could not extract metadata {os.path.basename(deb_filename)} (error code {result.exit_code})!', alert=True)
-                    self.logger.add(result.get_output(), pre=True)
-                    self.logger.send_all()
-                    return
-
-                # Merge md5sum metadata
-                with open(os.path.join(extract_folder, 'DEBIAN', 'md5sums'), 'a+') as target_hash_file:
-                    with open(os.path.join(aux_extract_folder, 'md5sums'), 'r') as source_hash_file:
-                        target_hash_file.write(source_hash_file.read())
-
-                # Remove secondary folder
-                if os.path.exists(aux_extract_folder):
-                    shutil.rmtree(aux_extract_folder)
+                return None
 
-            os.remove(deb_filename)
+            deb_filenames.append(deb_filename)
 
-        if not os.path.exists(control_filename):
-            self.logger.add(f'No control file for {pkg_name}...', alert=True)
-            self.logger.send_all()
-            return
+        return deb_filenames
 
-        # Rewrite the control file
-        with open(control_filename, 'r') as f:
-            control_lines = f.read().replace('\r', '').split('\n')
+    def rewrite_control(self, control, pkg_name, release_name):
+        control_lines = control.replace('\r', '').split('\n')
 
         # We have to rewrite the package name, the version
         # We will also remove all linux based dependencies
@@ -389,76 +510,237 @@ class PackageCollector(object):
                 conflicts = ', '.join(conflicts)
                 control_lines[i] = f'Conflicts: {conflicts}'
 
-        with open(control_filename, 'w') as f:
-            f.write('\n'.join(control_lines))
+        return '\n'.join(control_lines)
 
+    def rewrite_postrm(self, postrm):
         # The Ubuntu kernel images do not remove initrd.img in the postrm script.
         # Remove the initrd.img right before the fresh-install file is removed.
-        if os.path.exists(postrm_filename):
-            with open(postrm_filename, 'r') as f:
-                postrm_lines = f.read().replace('\r', '').split('\n')
+        # Returns None if the script does not have to be changed.
+        postrm_lines = postrm.replace('\r', '').split('\n')
 
-            if FIND_IMAGE_RM in postrm_lines:
-                index = postrm_lines.index(FIND_IMAGE_RM)
-                postrm_lines[index] = NEW_FIND_IMAGE_RM
+        if FIND_IMAGE_RM not in postrm_lines:
+            return None
 
-                for rm_line in INITRD_IMAGE_RMS:
-                    postrm_lines.insert(index, rm_line)
+        index = postrm_lines.index(FIND_IMAGE_RM)
+        postrm_lines[index] = NEW_FIND_IMAGE_RM
 
-                with open(postrm_filename, 'w') as f:
-                    f.write('\n'.join(postrm_lines))
+        for rm_line in INITRD_IMAGE_RMS:
+            postrm_lines.insert(index, rm_line)
 
-        # Repack the .deb file
-        result = utils.run_process(['dpkg-deb', '-Zgzip', '-b', extract_folder, deb_filename])
+        return '\n'.join(postrm_lines)
 
-        if result.failed:
-            self.logger.add(f'Could not pack {os.path.basename(deb_filename)} (error code {result.exit_code})!', alert=True)
-            self.logger.add(result.get_output(), pre=True)
-            self.logger.send_all()
+    def get_compression_policy(self, pkg_name):
+        # Packages are named like linux-current-modules-generic-amd64
+        pkg_type = pkg_name.split('-')[2]
+        return dict(DEFAULT_COMPRESSION_POLICY, **self.compression_policy.get(pkg_type, {}))
+
+    def get_data_codec(self, policy, upstream_codec):
+        # Returns the extension of the codec that the data member should be compressed with
+        if policy['codec'] != 'keep':
+            return compression.CODEC_EXTENSIONS[policy['codec']]
+
+        # We can't write every format that we can read
+        if upstream_codec in compression.CODEC_EXTENSIONS.values():
+            return upstream_codec
+
+        return 'gz'
+
+    def repack_package(self, release_name, release_type, pkg_name, deb_filenames):
+        # This is the second (CPU and disk-bound) stage of the pipeline.
+        # The packages are repacked in-process: tar entries are streamed from the
+        # upstream packages straight into the new package, without touching the disk.
+        # The new package is written to the staging folder of the pool, and is hashed while it is being written.
+        # Returns the staged package alongside its control file, hashes and file list, to be added to the pool by the main process.
+        deb_filename = self.pkg_list.get_staging_filename(pkg_name + '.deb')
+        release_name = self.get_package_version(release_name, release_type)
+        sources = []
+
+        try:
+            try:
+                # source_filename is the package that we're currently reading, in case it turns out to be broken
+                with tracing.tracer.span('read control files'):
+                    for source_filename in deb_filenames:
+                        sources.append(debfile.DebFile(source_filename))
+
+                    source_filename = deb_filenames[0]
+                    control_files = sources[0].read_control_files()
+
+                    # Auxiliary packages: merge md5sum metadata
+                    for source_filename, source in zip(deb_filenames[1:], sources[1:]):
+                        md5sums = source.read_control_files().get('md5sums', None)
+
+                        if md5sums is None:
+                            continue
+
+                        if 'md5sums' in control_files:
+                            control_files['md5sums'][1] += md5sums[1]
+                        else:
+                            control_files['md5sums'] = md5sums
+            except:
+                self.logger.add(f'Could not extract {os.path.basename(source_filename)}!', alert=True)
+                self.logger.add(traceback.format_exc(), pre=True)
+                self.logger.send_all()
+                return
+
+            if 'control' not in control_files:
+                self.logger.add(f'No control file for {pkg_name}...', alert=True)
+                self.logger.send_all()
+                return
+
+            # Rewrite the control file
+            control = control_files['control']
+            control[1] = self.rewrite_control(control[1].decode('utf-8'), pkg_name, release_name).encode('utf-8')
+
+            if 'postrm' in control_files:
+                postrm = control_files['postrm']
+                new_postrm = self.rewrite_postrm(postrm[1].decode('utf-8'))
+
+                if new_postrm is not None:
+                    postrm[1] = new_postrm.encode('utf-8')
+
+            # Repack the .deb file
+            try:
+                policy = self.get_compression_policy(pkg_name)
+                upstream_codec = sources[0].get_member('data.tar').compression
+                codec = self.get_data_codec(policy, upstream_codec)
+
+                with tracing.tracer.span('write package', codec=codec), open(deb_filename, 'wb') as f:
+                    hasher = utils.HashingWriter(f)
+                    writer = debfile.DebWriter(hasher)
+                    writer.add_control_files(control_files)
+
+                    # If there is only one upstream package, we've only changed its control member.
+                    # Unless our policy asks for another codec, the payload can be copied over as-is.
+                    if len(sources) == 1 and codec == upstream_codec:
+                        contents = writer.add_copied_data(sources[0])
+                    else:
+                        contents = writer.add_merged_data(sources, codec, policy['level'], policy['threads'])
+            except:
+                self.logger.add(f'Could not pack {os.path.basename(deb_filename)}!', alert=True)
+                self.logger.add(traceback.format_exc(), pre=True)
+                self.logger.send_all()
+                return
+        finally:
+            for source in sources:
+                source.close()
+
+        for source_filename in deb_filenames:
+            os.remove(source_filename)
+
+        return deb_filename, control[1].decode('utf-8'), hasher.get_hashes(), contents
+
+    def download_package_worker(self, pool, repack_slots, results, package):
+        release_link, release_name, release_type, pkg_name, filenames = package
+        deb_filenames = None
+
+        # Wait until there is room in the repack queue, so that downloaded packages never pile up
+        with tracing.tracer.span('wait for repack slot', package=pkg_name):
+            repack_slots.acquire()
+
+        # Don't start any new downloads while we're shutting down, the package will be retried during the next run
+        if self.stop_event.is_set():
+            repack_slots.release()
+            results.put((pkg_name, filenames, False, None))
             return
 
-        self.pkg_list.add_deb_to_pool(deb_filename)
+        try:
+            with metrics.PACKAGE_DURATION.time(stage='download'), tracing.tracer.span('download', package=pkg_name):
+                deb_filenames = self.download_package(release_link, release_name, release_type, pkg_name, filenames)
+        finally:
+            if not deb_filenames:
+                repack_slots.release()
+                results.put((pkg_name, filenames, deb_filenames is not None, None))
+
+        if not deb_filenames:
+            return
 
-        # Remove the temporary extract folder
-        if os.path.exists(extract_folder):
-            shutil.rmtree(extract_folder)
+        def on_repacked(result):
+            if isinstance(result, BaseException):
+                self.logger.add(f'Could not repack {pkg_name}!', alert=True)
+                self.logger.add(''.join(traceback.format_exception(type(result), result, result.__traceback__)), pre=True)
+                self.logger.send_all()
 
-    def download_files_worker(self, worker_args):
-        i, files = worker_args
+            staged = result if isinstance(result, tuple) else None
+            repack_slots.release()
+            results.put((pkg_name, filenames, staged is not None, staged))
 
-        logging.info(f'Starting worker number {i + 1} with {len(files)} packages to download...')
-        file_cache = {}
+        pool.apply_async(repack_package_worker, (release_name, release_type, pkg_name, deb_filenames), callback=on_repacked, error_callback=on_repacked)
 
-        # Go through all files
-        for release_link, release_name, release_type, pkg_name, filenames in files:
-            # Download and repack
-            self.download_and_repack(release_link, release_name, release_type, pkg_name, filenames)
-            file_cache[pkg_name] = filenames
+    def prune_downloads(self, downloadable):
+        # Remove leftover partial downloads of packages that we're no longer interested in
+        if not os.path.exists(self.download_dir):
+            os.makedirs(self.download_dir)
+            return
 
-        logging.info(f'Worker number {i + 1} has finished.')
-        return file_cache
+        expected = set()
+
+        for release_link, release_name, release_type, pkg_name, filenames in downloadable:
+            if release_type in ('linux-stable', 'linux-mainline'):
+                expected.add(f'{release_type}.src')
+            else:
+                expected.update(f'{pkg_name}_{i}.deb' for i in range(len(filenames)))
+
+        for file in os.listdir(self.download_dir):
+            if file.split('.part')[0] not in expected:
+                os.remove(os.path.join(self.download_dir, file))
 
     def find_downloadable_sources(self, release_type, release_version, release_link):
         filenames = [release_link]
 
         if self.file_cache.get(release_type, None) == filenames:
+            metrics.PACKAGES.inc(result='skipped')
             return []
 
         return [[release_link, f'v{release_version}', release_type, release_type, filenames]]
 
-    def find_downloadable_files(self, releases, release_type):
+    def get_release_link(self, release):
+        # Returns the link and the name of a release
+        if DAILY_RELEASE_REGEX.match(release):
+            return f'daily/{release}', release
+
+        return release, release[1:]
+
+    def probe_releases(self, channels):
+        # Fetch the file lists of the newest few releases of every channel concurrently.
+        # Most of the time, the newest release is complete, but if it is still being built,
+        # we won't have to wait for the next candidates one by one.
+        probes = []
+
+        for releases, release_type in channels:
+            for release in releases[:self.probe_depth]:
+                release_link, _ = self.get_release_link(release)
+                probes.append((release_link, release_type))
+
+        if not probes:
+            return {}
+
+        probed_files = {}
+
+        with tracing.tracer.span('probe', releases=len(probes)), ThreadPoolExecutor(max_workers=min(self.probe_workers, len(probes))) as executor:
+            futures = [(probe, executor.submit(self.get_files, *probe)) for probe in probes]
+
+            for probe, future in futures:
+                # Most probes are speculative, so a failed probe must not abort the run.
+                # If the release turns out to be needed, its file list is fetched again when it is checked.
+                try:
+                    probed_files[probe] = future.result()
+                except:
+                    logging.info(f'Could not probe {probe[0]}, it will be fetched again if needed.')
+
+        return probed_files
+
+    def find_downloadable_files(self, releases, release_type, probed_files=None):
         # Download the file list for this release
         required_types = ['image', 'modules', 'headers']
 
+        # The releases are still checked newest-first, the probed file lists just save us a request
         for release in releases:
-            if DAILY_RELEASE_REGEX.match(release):
-                release_link = f'daily/{release}'
-                release_name = release
-            else:
-                release_link = release
-                release_name = release[1:]
+            release_link, release_name = self.get_release_link(release)
+            files = probed_files.get((release_link, release_type), None) if probed_files else None
+
+            if files is None:
+                files = self.get_files(release_link, release_type)
 
-            files = self.get_files(release_link, release_type)
             current_types = []
 
             for pkg_name in files.keys():
@@ -483,6 +765,7 @@ class PackageCollector(object):
         for pkg_name, filenames in files.items():
             # Check our cache
             if self.file_cache.get(pkg_name, None) == filenames:
+                metrics.PACKAGES.inc(result='skipped')
                 continue
 
             filtered_files.append([release_link, release_name, release_type, pkg_name, filenames])
@@ -499,10 +782,15 @@ class PackageCollector(object):
             self.cache = {}
 
         self.file_cache = self.cache.get('files', {})
+        self.cache_changed = False
+        self.used_pages = set()
 
     def update_cache(self):
         # Save the cache to disk.
+        # Pages that we haven't visited during this run are no longer relevant.
         self.cache['files'] = self.file_cache
+        self.cache['pages'] = {url: page for url, page in self.cache.get('pages', {}).items() if url in self.used_pages}
+        self.cache_changed = False
 
         with open('cache.json', 'w') as file:
             json.dump(self.cache, file, sort_keys=True, indent=4, separators=(',', ': '))
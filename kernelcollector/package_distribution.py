@@ -1,19 +1,32 @@
-from deb_pkg_tools.control import unparse_control_fields
 from datetime import datetime
-from . import utils
-import traceback, logging, gzip, os
-import gnupg
+from . import metrics, pdiff, tracing
+import traceback, logging, hashlib, shutil, json, time, gzip, io, os
 
-gpg = gnupg.GPG()
-gpg.encoding = 'utf-8'
+# gpg is only started once there is something to sign
+gpg = None
+
+def get_gpg():
+    global gpg
+
+    if gpg is None:
+        import gnupg
+        gpg = gnupg.GPG()
+        gpg.encoding = 'utf-8'
+
+    return gpg
+
+# The hash algorithms listed in Release files, in the same order as our recorded hashes
+BY_HASH_ALGORITHMS = ['MD5Sum', 'SHA1', 'SHA256']
 
 class PackageDistribution(object):
 
-    def __init__(self, logger, name, architectures, description):
+    def __init__(self, logger, name, architectures, description, pdiff_history=30, by_hash_grace_period=86400):
         self.logger = logger
         self.name = name
         self.architectures = architectures
         self.description = description
+        self.pdiff_history = pdiff_history
+        self.by_hash_grace_period = by_hash_grace_period
 
     def set_package_list(self, pkg_list):
         self.pkg_list = pkg_list
@@ -22,9 +35,218 @@ class PackageDistribution(object):
             return
 
         self.folder = os.path.join(self.pkg_list.dist_folder, self.name)
+        self.state_filename = os.path.join(self.pkg_list.state_folder, 'dists', f'{self.name}.json')
+        self.pkg_list.move_state_file(os.path.join(self.folder, 'index.json'), self.state_filename)
+
+        for folder in (self.folder, os.path.dirname(self.state_filename)):
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+    def load_state(self):
+        # The state remembers what every architecture was built from, and the hashes of every index file.
+        # If it is missing or corrupt, we simply rebuild everything.
+        try:
+            with open(self.state_filename, 'r') as file:
+                return json.load(file)
+        except:
+            return {'architectures': {}, 'files': {}, 'pdiffs': {}, 'byHash': {}, 'release': None}
+
+    def save_state(self, state):
+        tmp_filename = f'{self.state_filename}.tmp'
+
+        with open(tmp_filename, 'w') as file:
+            json.dump(state, file, sort_keys=True, separators=(',', ':'))
+
+        os.replace(tmp_filename, self.state_filename)
+
+    def get_stat(self, full_path):
+        stat = os.stat(full_path)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def get_recorded_file(self, state, display_path):
+        # Returns the recorded hashes of an index file, but only if it has not changed on disk since
+        entry = state['files'].get(display_path, None)
+
+        try:
+            if entry is not None and entry['stat'] == self.get_stat(os.path.join(self.folder, display_path)):
+                return entry
+        except OSError:
+            pass
+
+        return None
+
+    def write_index_file(self, state, display_path, data):
+        # Writes an index file, unless its content is identical to what is already on disk.
+        # The hashes are computed from memory, the file never has to be read back.
+        # Returns True if the file was written.
+        sha256 = hashlib.sha256(data).hexdigest()
+        entry = self.get_recorded_file(state, display_path)
+
+        if entry is not None and entry['hashes'][2] == sha256:
+            metrics.INDEX_FILES.inc(result='unchanged')
+            return False
+
+        full_path = os.path.join(self.folder, display_path)
+        tmp_filename = f'{full_path}.tmp'
+
+        with open(tmp_filename, 'wb') as file:
+            file.write(data)
+
+        os.replace(tmp_filename, full_path)
+        metrics.INDEX_FILES.inc(result='written')
+        metrics.INDEX_BYTES.inc(len(data))
+        state['files'][display_path] = {
+            'stat': self.get_stat(full_path),
+            'hashes': [hashlib.md5(data).hexdigest(), hashlib.sha1(data).hexdigest(), sha256]
+        }
+        return True
+
+    def update_pdiffs(self, state, arch, display_dir, packages):
+        # Keeps a history of patches between the previous versions of the package list,
+        # so that apt can download a few small patches instead of the whole package list.
+        diff_dir = os.path.join(self.folder, display_dir, 'Packages.diff')
+        packages_path = os.path.join(display_dir, 'Packages')
+        patches = state['pdiffs'].get(arch, [])
+        old = None
+
+        # We can only diff against a package list that we've written ourselves, otherwise the history wouldn't add up
+        if self.get_recorded_file(state, packages_path) is not None:
+            with open(os.path.join(self.folder, packages_path), 'rb') as file:
+                old = file.read()
+
+        if old is None:
+            patches = []
+        elif old != packages:
+            # Patches are named after the time they were made, publishing twice in the same second adds a counter
+            base_name = datetime.utcnow().strftime('%Y-%m-%d-%H%M.%S')
+            names = set(patch['name'] for patch in patches)
+            name = base_name
+            counter = 1
+
+            while name in names:
+                name = f'{base_name}-{counter}'
+                counter += 1
+
+            try:
+                script = pdiff.make_ed_script(old, packages)
+            except pdiff.PdiffException as e:
+                # Clients will have to download the whole package list
+                self.logger.add(f'Could not create a package list diff for {arch}, starting a new history: {e}')
+                self.logger.send_all()
+                patches = []
+            else:
+                compressed = gzip.compress(script, mtime=0)
+
+                if not os.path.exists(diff_dir):
+                    os.makedirs(diff_dir)
+
+                with open(os.path.join(diff_dir, f'{name}.gz'), 'wb') as file:
+                    file.write(compressed)
+
+                patches.append({'name': name, 'history': pdiff.get_hash(old), 'patch': pdiff.get_hash(script), 'download': pdiff.get_hash(compressed)})
+
+        patches = patches[-self.pdiff_history:] if self.pdiff_history else []
+        state['pdiffs'][arch] = patches
+
+        # Remove patches that have fallen out of the history, and the index if there is no history left.
+        # The by-hash copies of the index are left alone, they are expired by collect_by_hash after their grace period.
+        if os.path.exists(diff_dir):
+            names = set(f'{patch["name"]}.gz' for patch in patches)
+
+            if patches:
+                names.add('Index')
+
+            for file in os.listdir(diff_dir):
+                filename = os.path.join(diff_dir, file)
+
+                if file not in names and os.path.isfile(filename):
+                    os.remove(filename)
+
+        if patches:
+            return self.write_index_file(state, os.path.join(display_dir, 'Packages.diff', 'Index'), pdiff.make_index(pdiff.get_hash(packages), patches).encode('utf-8'))
+
+        return False
+
+    def publish_by_hash(self, state, display_path):
+        # Makes an index file available under by-hash/<algorithm>/<digest>, next to the file itself.
+        # Index files are always replaced rather than modified, so the by-hash files can simply be hard links.
+        # Returns the display paths of the by-hash files.
+        full_path = os.path.join(self.folder, display_path)
+        folder = os.path.dirname(display_path)
+        by_hash_paths = []
+
+        for algorithm, digest in zip(BY_HASH_ALGORITHMS, state['files'][display_path]['hashes']):
+            by_hash_path = os.path.join(folder, 'by-hash', algorithm, digest)
+            by_hash_filename = os.path.join(self.folder, by_hash_path)
+            by_hash_paths.append(by_hash_path)
+
+            if os.path.exists(by_hash_filename):
+                continue
+
+            if not os.path.exists(os.path.dirname(by_hash_filename)):
+                os.makedirs(os.path.dirname(by_hash_filename))
 
-        if not os.path.exists(self.folder):
-            os.makedirs(self.folder)
+            try:
+                os.link(full_path, by_hash_filename)
+            except OSError:
+                shutil.copyfile(full_path, by_hash_filename)
+
+        return by_hash_paths
+
+    def collect_by_hash(self, state, referenced):
+        # By-hash files that are no longer referenced are kept around for a grace period,
+        # because clients (and caches) might still be working with an older Release file.
+        now = int(time.time())
+
+        for by_hash_path in referenced:
+            state['byHash'][by_hash_path] = None
+
+        for by_hash_path, unreferenced_since in list(state['byHash'].items()):
+            if by_hash_path in referenced:
+                continue
+
+            if unreferenced_since is None:
+                state['byHash'][by_hash_path] = now
+                continue
+
+            if now - unreferenced_since < self.by_hash_grace_period:
+                continue
+
+            by_hash_filename = os.path.join(self.folder, by_hash_path)
+
+            if os.path.exists(by_hash_filename):
+                os.remove(by_hash_filename)
+
+            del state['byHash'][by_hash_path]
+
+    def make_contents(self, releases):
+        # Creates a compressed Contents file, which maps every file to the packages that contain it.
+        # The file lists were recorded when the packages were added to the pool, so no package has to be opened here.
+        locations = {}
+
+        for data, contents in releases:
+            section = data.get('Section', None)
+            location = f'{section}/{data["Package"]}' if section else data['Package']
+
+            for path in contents:
+                locations.setdefault(path, []).append(location)
+
+        buffer = io.BytesIO()
+
+        with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as file:
+            for path in sorted(locations):
+                file.write(f'{path:<55} {",".join(locations[path])}\n'.encode('utf-8'))
+
+        return buffer.getvalue()
+
+    def get_fingerprint(self, arch, releases):
+        # Everything that ends up in the index files of an architecture is derived from these
+        fingerprint = hashlib.sha256(f'{arch}\n{self.description}\n'.encode('utf-8'))
+
+        for data, contents in releases:
+            fingerprint.update(f'{data["Filename"]} {data["SHA256"]}\n'.encode('utf-8'))
+
+        return fingerprint.hexdigest()
 
     def get_arch_dir(self, arch):
         return os.path.join(self.folder, 'main', f'binary-{arch}')
@@ -32,82 +254,143 @@ class PackageDistribution(object):
     def sign_file(self, filename, content, detach=False):
         with open(filename, 'w') as file:
             try:
-                file.write(str(gpg.sign(content, detach=detach, keyid=self.pkg_list.gpg_key, passphrase=self.pkg_list.gpg_password)))
+                signature = get_gpg().sign(content, detach=detach, keyid=self.pkg_list.gpg_key, passphrase=self.pkg_list.gpg_password)
+
+                if not signature:
+                    raise Exception(f'gpg could not sign the file: {signature.status}')
+
+                file.write(str(signature))
+                return True
             except:
                 self.logger.add(f'Could not sign {filename}! Please check your GPG keys!', alert=True)
                 self.logger.add(traceback.format_exc(), pre=True)
                 self.logger.send_all()
+                return False
 
     def save(self, releases):
-        main_dir = os.path.join(self.folder, 'main')
-        arch_to_packages = {arch: [] for arch in self.architectures}
+        from deb_pkg_tools.control import unparse_control_fields
+
+        index_start = time.monotonic()
+        state = self.load_state()
+        state.setdefault('pdiffs', {})
+        state.setdefault('byHash', {})
+        arch_to_releases = {arch: [] for arch in self.architectures}
+        index_files = []
+        changed = False
 
         logging.info('Writing package list to disk...')
 
         # Associate our packages with architectures.
         for release in releases:
-            full_path, data = release
+            full_path, data, contents = release
             arch = data['Architecture'].lower()
-            data = unparse_control_fields(data).dump()
 
             if arch == 'all':
                 for arch in self.architectures:
-                    arch_to_packages[arch].append(data)
+                    arch_to_releases[arch].append([data, contents])
             elif arch in self.architectures:
-                arch_to_packages[arch].append(data)
+                arch_to_releases[arch].append([data, contents])
 
-        # Write our package lists for all architectures.
+        # Write our package lists, but only for architectures whose packages have changed.
         for arch in self.architectures:
             arch_dir = self.get_arch_dir(arch)
+            display_dir = arch_dir[len(self.folder):].lstrip('/')
+            arch_files = [os.path.join(display_dir, file) for file in ('Packages', 'Packages.gz', 'Release')]
+            arch_files.append(os.path.join('main', f'Contents-{arch}.gz'))
+            diff_index = os.path.join(display_dir, 'Packages.diff', 'Index')
+
+            fingerprint = self.get_fingerprint(arch, arch_to_releases[arch])
+            up_to_date = state['architectures'].get(arch, None) == fingerprint and all(self.get_recorded_file(state, display_path) for display_path in arch_files)
+
+            if up_to_date and state['pdiffs'].get(arch, None):
+                up_to_date = self.get_recorded_file(state, diff_index) is not None
+
+            if up_to_date:
+                index_files.extend(arch_files)
+
+                if state['pdiffs'].get(arch, None):
+                    index_files.append(diff_index)
+
+                continue
+
+            logging.info(f'Writing package list for {arch}...')
 
             if not os.path.exists(arch_dir):
                 os.makedirs(arch_dir)
 
-            with open(os.path.join(arch_dir, 'Release'), 'w') as file:
-                file.write('\n'.join([
-                    'Component: main', 'Origin: linux-kernel', 'Label: linux-kernel',
-                    f'Architecture: {arch}', f'Description: {self.description}'
-                ]))
+            release = '\n'.join([
+                'Component: main', 'Origin: linux-kernel', 'Label: linux-kernel',
+                f'Architecture: {arch}', f'Description: {self.description}'
+            ])
+            packages = '\n'.join(unparse_control_fields(data).dump() for data, contents in arch_to_releases[arch]).encode('utf-8')
+            changed |= self.update_pdiffs(state, arch, display_dir, packages)
 
-            packages = '\n'.join(arch_to_packages[arch])
+            # The modification time is left out of the gzip header, so that identical package lists compress identically
+            changed |= self.write_index_file(state, arch_files[0], packages)
+            changed |= self.write_index_file(state, arch_files[1], gzip.compress(packages, mtime=0))
+            changed |= self.write_index_file(state, arch_files[2], release.encode('utf-8'))
+            changed |= self.write_index_file(state, arch_files[3], self.make_contents(arch_to_releases[arch]))
+            state['architectures'][arch] = fingerprint
+            index_files.extend(arch_files)
 
-            with open(os.path.join(arch_dir, 'Packages'), 'w') as file:
-                file.write(packages)
+            if state['pdiffs'][arch]:
+                index_files.append(diff_index)
 
-            with gzip.open(os.path.join(arch_dir, 'Packages.gz'), 'wt') as file:
-                file.write(packages)
+        # Forget about architectures that we no longer build
+        state['architectures'] = {arch: fingerprint for arch, fingerprint in state['architectures'].items() if arch in self.architectures}
+        state['pdiffs'] = {arch: patches for arch, patches in state['pdiffs'].items() if arch in self.architectures}
+        state['files'] = {display_path: entry for display_path, entry in state['files'].items() if display_path in index_files}
 
         # Gather hashes for the architecture package lists.
+        # Their hashes have been recorded when they were written.
         md5s = []
         sha1s = []
         sha256s = []
+        by_hash_paths = set()
 
-        date = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S UTC')
-
-        for root, _, files in os.walk(main_dir):
-            for file in files:
-                full_path = os.path.join(root, file)
-                display_path = full_path[len(self.folder):].lstrip('/')
-
-                md5, sha1, sha256 = utils.get_all_hashes(full_path)
-                size = str(os.path.getsize(full_path))
-                md5s.append(f' {md5} {size} {display_path}')
-                sha1s.append(f' {sha1} {size} {display_path}')
-                sha256s.append(f' {sha256} {size} {display_path}')
+        for display_path in index_files:
+            entry = state['files'][display_path]
+            md5, sha1, sha256 = entry['hashes']
+            size = str(entry['stat'][0])
+            md5s.append(f' {md5} {size} {display_path}')
+            sha1s.append(f' {sha1} {size} {display_path}')
+            sha256s.append(f' {sha256} {size} {display_path}')
+            by_hash_paths.update(self.publish_by_hash(state, display_path))
 
         # Save the final package list, signing
         archs = ' '.join(self.architectures)
         md5s = '\n'.join(md5s)
         sha1s = '\n'.join(sha1s)
         sha256s = '\n'.join(sha256s)
-        release = '\n'.join([
-            'Origin: linux-kernel', 'Label: linux-kernel', f'Suite: {self.name}', f'Codename: {self.name}', f'Date: {date}',
-            f'Architectures: {archs}', 'Components: main', f'Description: {self.description}',
+        release_fields = [
+            'Origin: linux-kernel', 'Label: linux-kernel', f'Suite: {self.name}', f'Codename: {self.name}',
+            f'Architectures: {archs}', 'Components: main', f'Description: {self.description}', 'Acquire-By-Hash: yes',
             f'MD5Sum:\n{md5s}', f'SHA1:\n{sha1s}', f'SHA256:\n{sha256s}'
-        ])
+        ]
+
+        self.collect_by_hash(state, by_hash_paths)
+
+        # If none of the index files have changed, the signed release files are still up to date
+        release_files = [os.path.join(self.folder, file) for file in ('Release', 'InRelease', 'Release.gpg')]
+
+        if not changed and state.get('release', None) == release_fields and all(os.path.exists(filename) for filename in release_files):
+            logging.info(f'Package list of {self.name} is already up to date.')
+            self.save_state(state)
+            metrics.STAGE_DURATION.observe(time.monotonic() - index_start, stage='index')
+            return
 
-        with open(os.path.join(self.folder, 'Release'), 'w') as file:
+        date = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S UTC')
+        release = '\n'.join(release_fields[:4] + [f'Date: {date}'] + release_fields[4:])
+
+        with open(release_files[0], 'w') as file:
             file.write(release)
 
-        self.sign_file(os.path.join(self.folder, 'InRelease'), release, detach=False)
-        self.sign_file(os.path.join(self.folder, 'Release.gpg'), release, detach=True)
+        metrics.STAGE_DURATION.observe(time.monotonic() - index_start, stage='index')
+
+        with metrics.STAGE_DURATION.time(stage='sign'), tracing.tracer.span('sign'):
+            signed = self.sign_file(release_files[1], release, detach=False)
+            signed &= self.sign_file(release_files[2], release, detach=True)
+
+        # Try again next time if signing has failed
+        state['release'] = release_fields if signed else None
+        self.save_state(state)
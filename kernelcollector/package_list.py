@@ -1,6 +1,5 @@
-from deb_pkg_tools.package import inspect_package_fields
-from looseversion import LooseVersion
-from . import utils
+from .pool_index import PoolIndex
+from . import debfile, hashing, metrics, tracing, utils
 import shutil, logging, time, os
 
 class PackageList(object):
@@ -19,11 +18,66 @@ class PackageList(object):
         self.pool_folder = os.path.join(self.repo_path, 'pool', 'main')
         self.dist_folder = os.path.join(self.repo_path, 'dists')
 
+        # Our own state and half-written packages are kept out of the published part of the repository,
+        # but still on the same filesystem, so that packages can be renamed into the pool
+        self.state_folder = os.path.join(self.repo_path, '.kernelcollector')
+        self.staging_folder = os.path.join(self.state_folder, 'staging')
+        self.move_state_file(os.path.join(self.repo_path, 'pool', 'index.json'), os.path.join(self.state_folder, 'pool.json'))
+        self.index = PoolIndex(os.path.join(self.state_folder, 'pool.json'))
+
+        # Older versions built packages inside of the pool
+        old_staging_folder = os.path.join(self.repo_path, 'pool', 'staging')
+
+        if os.path.exists(old_staging_folder):
+            shutil.rmtree(old_staging_folder)
+
+    def move_state_file(self, old_filename, filename):
+        # Older versions kept their state inside of the published part of the repository
+        if not os.path.exists(old_filename):
+            return
+
+        if os.path.exists(filename):
+            os.remove(old_filename)
+            return
+
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        os.replace(old_filename, filename)
+
+    def get_pool_filename(self, full_path):
+        # Pool filenames are relative to the root of the repository
+        return full_path[len(self.repo_path):].lstrip('/')
+
     def add_distribution(self, distribution):
         distribution.set_package_list(self)
         self.distributions[distribution.name] = distribution
 
-    def add_deb_to_pool(self, filename):
+    def clear_staging(self):
+        # Packages are built in the staging folder, which is on the same filesystem as the pool.
+        # This way, they can be renamed into the pool instead of being copied.
+        if os.path.exists(self.staging_folder):
+            shutil.rmtree(self.staging_folder)
+
+        os.makedirs(self.staging_folder)
+
+    def get_staging_filename(self, basename):
+        return os.path.join(self.staging_folder, basename)
+
+    def get_control_fields(self, control):
+        # Returns the unparsed (string) form of the control fields, with plain string keys,
+        # so that they can be serialized to the index.
+        from deb_pkg_tools.control import parse_control_fields, unparse_control_fields
+        from deb_pkg_tools.deb822 import parse_deb822
+        return {str(name): value for name, value in unparse_control_fields(parse_control_fields(parse_deb822(control))).items()}
+
+    def get_package_contents(self, full_path):
+        with debfile.DebFile(full_path) as deb:
+            return deb.get_contents()
+
+    def add_deb_to_pool(self, filename, control, hashes, contents):
+        # The control file, the hashes and the file list of the package are already known,
+        # because they were produced while the package was being written.
         basename = os.path.basename(filename)
         logging.info(f'Adding {basename} to pool...')
 
@@ -33,15 +87,13 @@ class PackageList(object):
         if not os.path.exists(pool_folder):
             os.makedirs(pool_folder)
 
-        # Remove any old deb package, and move from original location to pool
+        # Replace any old deb package, and move from original location to pool
         no_ext, ext = os.path.splitext(basename)
-        pool_filename = os.path.join(pool_folder, f'{no_ext}_tmp{ext}')
+        full_path = os.path.join(pool_folder, f'{no_ext}_tmp{ext}')
+        utils.move_file(filename, full_path)
 
-        if os.path.exists(pool_filename):
-            os.remove(pool_filename)
-
-        shutil.copyfile(filename, pool_filename)
-        os.remove(filename)
+        pool_filename = self.get_pool_filename(full_path)
+        self.index.set(pool_filename, full_path, self.get_control_fields(control), hashes, contents)
         self.recently_added[basename] = None # Version to be filled out in get_all_releases_in_pool
 
     def save_all_distributions(self, letters):
@@ -49,11 +101,18 @@ class PackageList(object):
         logging.info('Saving package list...')
         releases = []
 
-        for letter in letters:
-            releases.extend(self.get_all_releases_in_pool(letter))
+        with metrics.STAGE_DURATION.time(stage='inspect'), tracing.tracer.span('inspect'):
+            for letter in letters:
+                releases.extend(self.get_all_releases_in_pool(letter))
+
+            self.index.prune(self.repo_path)
+            self.index.save()
+
+        metrics.POOL_PACKAGES.set(len(releases))
 
         for distribution in self.distributions.values():
-            distribution.save(releases)
+            with tracing.tracer.span('index', distribution=distribution.name):
+                distribution.save(releases)
 
     def send_embedded_report(self):
         description = [f'**{filename}** has been updated to **v{version}**!' for filename, version in self.recently_added.items() if version is not None]
@@ -82,7 +141,15 @@ class PackageList(object):
         self.logger.add_embed(content)
         self.logger.send_all()
 
+        # Only report every package once, even if we keep running
+        self.recently_added = {}
+
     def get_all_releases_in_pool(self, letter):
+        # These are only needed when publishing, they're slow to import
+        from deb_pkg_tools.package import inspect_package_fields
+        from deb_pkg_tools.control import unparse_control_fields
+        from looseversion import LooseVersion
+
         pool_folder = os.path.join(self.pool_folder, letter)
 
         # If we have no pool folder, there are no artifacts.
@@ -97,30 +164,46 @@ class PackageList(object):
             full_path = os.path.join(pool_folder, file)
             new_file = full_path[:-len('_tmp.deb')] + '.deb'
 
-            if os.path.exists(new_file):
-                os.remove(new_file)
+            # Renames keep the size, modification time and inode, so the indexed metadata stays valid
+            os.replace(full_path, new_file)
+            self.index.rename(self.get_pool_filename(full_path), self.get_pool_filename(new_file))
 
-            shutil.move(full_path, new_file)
+        # Hash all packages that are new or have changed since we've last seen them at the same time
+        files = [os.path.join(pool_folder, file) for file in sorted(os.listdir(pool_folder))]
+        hashes = hashing.hash_files([full_path for full_path in files if full_path.endswith('.deb') and self.index.get(self.get_pool_filename(full_path), full_path) is None])
 
         # We have to gather all packages
         pkg_to_versions = {}
 
-        for file in sorted(os.listdir(pool_folder)):
-            full_path = os.path.join(pool_folder, file)
-
+        for full_path in files:
             if not full_path.endswith('.deb'):
                 os.remove(full_path)
                 continue
 
             basename = os.path.basename(full_path)
-            logging.info(f'Inspecting {basename}...')
-
-            try:
-                data = inspect_package_fields(full_path)
-            except:
-                os.remove(full_path)
-                continue
-
+            pool_filename = self.get_pool_filename(full_path)
+            entry = self.index.get(pool_filename, full_path)
+            metrics.POOL_INSPECTIONS.inc(result='inspected' if entry is None else 'cached')
+
+            if entry is None:
+                # This package is new or has changed since we've last seen it
+                logging.info(f'Inspecting {basename}...')
+
+                try:
+                    fields = {str(name): value for name, value in unparse_control_fields(inspect_package_fields(full_path)).items()}
+                    contents = self.get_package_contents(full_path)
+                except:
+                    self.index.remove(pool_filename)
+                    os.remove(full_path)
+                    continue
+
+                entry = self.index.set(pool_filename, full_path, fields, hashes[full_path], contents)
+            elif 'contents' not in entry:
+                # This package was indexed before we kept track of file lists
+                logging.info(f'Listing files of {basename}...')
+                self.index.set_contents(pool_filename, self.get_package_contents(full_path))
+
+            data = dict(entry['fields'])
             pkg_name = data['Package']
             version = data['Version']
             pkg = pkg_to_versions.get(pkg_name, {})
@@ -128,22 +211,20 @@ class PackageList(object):
             if version in pkg:
                 self.logger.add(f'Removing duplicate version {version} from package {pkg_name}...')
                 self.logger.send_all()
+                self.index.remove(pool_filename)
                 os.remove(full_path)
                 continue
 
             if basename in self.recently_added:
                 self.recently_added[basename] = version
 
-            pool_filename = os.path.join(pool_folder, basename)[len(self.repo_path):].lstrip('/')
-            md5, sha1, sha256 = utils.get_all_hashes(full_path)
             data['Filename'] = pool_filename
-            data['Size'] = str(os.path.getsize(full_path))
-            data['MD5sum'] = md5
-            data['SHA1'] = sha1
-            data['SHA256'] = sha256
-            pkg[version] = [full_path, data]
-            pkg_to_versions[pkg_name] = pkg
 
+            for key in ('Size', 'MD5sum', 'SHA1', 'SHA256'):
+                data[key] = entry[key]
+
+            pkg[version] = [full_path, data, entry['contents']]
+            pkg_to_versions[pkg_name] = pkg
 
         releases = []
 
@@ -151,7 +232,7 @@ class PackageList(object):
         for pkg_name, versions in pkg_to_versions.items():
             if len(versions) == 1:
                 # There is only one version, which is always the newest.
-                full_path, data = list(versions.values())[0]
+                release = list(versions.values())[0]
             else:
                 # Look for the newest version
                 newest_version = None
@@ -162,7 +243,7 @@ class PackageList(object):
                         newest_version = LooseVersion(version)
                         newest_version_name = version
 
-                full_path, data = versions[newest_version_name]
+                release = versions[newest_version_name]
 
                 # Delete all previous versions from the pool
                 for version, pkg_list in versions.items():
@@ -174,6 +255,6 @@ class PackageList(object):
                     self.logger.send_all()
                     os.remove(filename)
 
-            releases.append([full_path, data])
+            releases.append(release)
 
         return releases
@@ -0,0 +1,52 @@
+from difflib import SequenceMatcher
+import hashlib
+
+class PdiffException(Exception):
+    pass
+
+def make_ed_script(old, new):
+    # Returns an ed script that turns the old file into the new one, in the format of `diff --ed`.
+    # Changes are listed from the bottom of the file to the top, so that line numbers stay valid while applying them.
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+
+    # Lines that only contain a dot would end an ed insertion early
+    if b'.\n' in new_lines:
+        raise PdiffException('Cannot express a line containing a single dot in an ed script.')
+
+    script = []
+
+    for tag, i1, i2, j1, j2 in reversed(SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()):
+        if tag == 'equal':
+            continue
+
+        lines = f'{i1 + 1},{i2}' if i2 - i1 > 1 else f'{i1 + 1}'
+
+        if tag == 'delete':
+            script.append(f'{lines}d\n'.encode('ascii'))
+            continue
+
+        if tag == 'insert':
+            script.append(f'{i1}a\n'.encode('ascii'))
+        else:
+            script.append(f'{lines}c\n'.encode('ascii'))
+
+        script.extend(new_lines[j1:j2])
+        script.append(b'.\n')
+
+    return b''.join(script)
+
+def get_hash(data):
+    return [hashlib.sha256(data).hexdigest(), len(data)]
+
+def make_index(current, patches):
+    # Creates the Packages.diff/Index file.
+    # Every patch turns the file listed in the history into the file that the next patch applies to.
+    history = '\n'.join(f' {patch["history"][0]} {patch["history"][1]} {patch["name"]}' for patch in patches)
+    uncompressed = '\n'.join(f' {patch["patch"][0]} {patch["patch"][1]} {patch["name"]}' for patch in patches)
+    download = '\n'.join(f' {patch["download"][0]} {patch["download"][1]} {patch["name"]}.gz' for patch in patches)
+
+    return '\n'.join([
+        f'SHA256-Current: {current[0]} {current[1]}', f'SHA256-History:\n{history}',
+        f'SHA256-Patches:\n{uncompressed}', f'SHA256-Download:\n{download}'
+    ]) + '\n'
@@ -0,0 +1,100 @@
+import json, os
+
+class PoolIndex(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        # The index maps pool filenames to the metadata we've gathered about them.
+        # If the index is missing or corrupt, we simply start over and re-inspect the pool.
+        try:
+            with open(self.filename, 'r') as file:
+                self.entries = json.load(file)
+        except:
+            self.entries = {}
+
+        self.dirty = False
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        folder = os.path.dirname(self.filename)
+
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # Write to a temporary file first, so that an interrupted save never leaves a truncated index behind
+        tmp_filename = f'{self.filename}.tmp'
+
+        with open(tmp_filename, 'w') as file:
+            json.dump(self.entries, file, sort_keys=True, separators=(',', ':'))
+
+        os.replace(tmp_filename, self.filename)
+        self.dirty = False
+
+    def get_stat(self, full_path):
+        stat = os.stat(full_path)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def get(self, pool_filename, full_path):
+        # Returns the indexed metadata of a pool file,
+        # but only if the file has not changed since it was indexed.
+        entry = self.entries.get(pool_filename, None)
+
+        if entry is None:
+            return None
+
+        try:
+            stat = self.get_stat(full_path)
+        except OSError:
+            return None
+
+        if entry['stat'] != stat:
+            return None
+
+        return entry
+
+    def set(self, pool_filename, full_path, fields, hashes, contents):
+        md5, sha1, sha256 = hashes
+        stat = self.get_stat(full_path)
+        entry = {
+            'stat': stat,
+            'fields': fields,
+            'Size': str(stat[0]),
+            'MD5sum': md5,
+            'SHA1': sha1,
+            'SHA256': sha256,
+            'contents': contents
+        }
+
+        self.entries[pool_filename] = entry
+        self.dirty = True
+        return entry
+
+    def set_contents(self, pool_filename, contents):
+        self.entries[pool_filename]['contents'] = contents
+        self.dirty = True
+
+    def remove(self, pool_filename):
+        if self.entries.pop(pool_filename, None) is not None:
+            self.dirty = True
+
+    def rename(self, old_pool_filename, new_pool_filename):
+        entry = self.entries.pop(old_pool_filename, None)
+        self.entries.pop(new_pool_filename, None)
+
+        if entry is not None:
+            self.entries[new_pool_filename] = entry
+
+        self.dirty = True
+
+    def prune(self, repo_path):
+        # Forget about all files that have disappeared from the pool.
+        for pool_filename in list(self.entries.keys()):
+            if not os.path.exists(os.path.join(repo_path, pool_filename)):
+                self.remove(pool_filename)
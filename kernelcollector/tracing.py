@@ -0,0 +1,113 @@
+import threading, json, time, os
+
+class NullSpan(object):
+    # Handed out while tracing is disabled, so that spans cost next to nothing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class Span(object):
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic_ns()
+        return self
+
+    def __exit__(self, *args):
+        end = time.monotonic_ns()
+        self.tracer.add_span(self.name, self.start, end, self.args)
+
+class Tracer(object):
+    # Records spans as Chrome trace events, which can be opened in Perfetto or chrome://tracing.
+    # The monotonic clock is shared by all processes, so the spans of worker processes line up with ours.
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.threads = set()
+        self.lock = threading.Lock()
+        self.forward_queue = None
+
+    def enable(self, process_name='kernelcollector'):
+        self.enabled = True
+        self.set_process_name(process_name)
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+
+        return Span(self, name, args)
+
+    def set_process_name(self, name):
+        self.add_event({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': name}})
+
+    def add_span(self, name, start, end, args):
+        pid = os.getpid()
+        tid = threading.get_native_id()
+        event = {'name': name, 'ph': 'X', 'ts': start / 1000, 'dur': (end - start) / 1000, 'pid': pid, 'tid': tid}
+
+        if args:
+            event['args'] = {key: str(value) for key, value in args.items()}
+
+        # Threads are named once, the first time they show up
+        if (pid, tid) not in self.threads:
+            self.threads.add((pid, tid))
+            self.add_event({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': threading.current_thread().name}})
+
+        self.add_event(event)
+
+    def add_event(self, event):
+        # Worker processes hand their events over to the main process, which writes the trace
+        if self.forward_queue is not None:
+            self.forward_queue.put(event)
+            return
+
+        with self.lock:
+            self.events.append(event)
+
+    def forward_to(self, forward_queue, process_name):
+        # Used by worker processes: the lock might have been held by another thread while forking.
+        # Worker processes that weren't forked don't know that tracing is enabled yet.
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = set()
+        self.forward_queue = forward_queue
+        self.set_process_name(process_name)
+
+    def receive(self, forward_queue):
+        for event in iter(forward_queue.get, None):
+            with self.lock:
+                self.events.append(event)
+
+    def start_receiver(self, forward_queue):
+        receiver = threading.Thread(target=self.receive, args=(forward_queue,), daemon=True)
+        receiver.start()
+        return receiver
+
+    def write(self, filename):
+        # Writes everything recorded so far and starts over
+        # The names of our own process and threads are kept for the next trace
+        pid = os.getpid()
+
+        with self.lock:
+            events = self.events
+            self.events = [event for event in events if event['ph'] == 'M' and event['pid'] == pid]
+
+        tmp_filename = f'{filename}.tmp'
+
+        with open(tmp_filename, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+        os.replace(tmp_filename, filename)
+
+tracer = Tracer()
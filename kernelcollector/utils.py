@@ -1,9 +1,38 @@
-import hashlib, subprocess, re, zlib, lzma
-import requests
+from . import compression, hashing, metrics, tracing
+import hashlib, subprocess, threading, logging, shutil, fcntl, errno, queue, json, time, re, zlib, os
+
+HTTP_HEADERS = {'User-Agent': 'KernelCollector'}
+
+# The ioctl used to clone a file's data blocks on copy-on-write filesystems (btrfs, XFS)
+FICLONE = 0x40049409
+
+# The HTTP session is shared by everything that talks to the network within a process.
+http_config = {'timeout': (10, 60), 'connections': 8, 'retries': 3}
+http_session = None
+http_session_pid = None
 
 class ContentTypeException(Exception):
     pass
 
+class HashingWriter(object):
+    # Passes all writes through to a file, while computing its size and hashes on the fly
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.name = fileobj.name
+        self.size = 0
+        self.hashes = [hashlib.md5(), hashlib.sha1(), hashlib.sha256()]
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.size += len(data)
+
+        for hash in self.hashes:
+            hash.update(data)
+
+    def get_hashes(self):
+        return tuple(hash.hexdigest() for hash in self.hashes)
+
 class ProcessOutput(object):
 
     def __init__(self, lines, exit_code):
@@ -43,6 +72,46 @@ def run_process(process):
     process.wait()
     return ProcessOutput(lines, process.returncode)
 
+def configure_http(timeout, connections, retries):
+    global http_session
+
+    http_config['timeout'] = tuple(timeout) if isinstance(timeout, list) else timeout
+    http_config['connections'] = connections
+    http_config['retries'] = retries
+    http_session = None
+
+def get_http_session():
+    global http_session, http_session_pid
+
+    # Connections cannot be shared between processes, so every worker process creates its own session
+    if http_session is not None and http_session_pid == os.getpid():
+        return http_session
+
+    # requests is slow to import, it's only loaded once we actually need to talk to a server
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    import requests
+
+    # Keep-alive connections are pooled per host.
+    # Once all connections to a host are busy, new requests wait for a free connection instead of opening another one.
+    retries = Retry(total=http_config['retries'], backoff_factor=1, status_forcelist=(502, 503, 504), allowed_methods=('HEAD', 'GET'), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=http_config['connections'], pool_block=True, max_retries=retries)
+
+    http_session = requests.Session()
+    http_session.headers.update(HTTP_HEADERS)
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    http_session_pid = os.getpid()
+    return http_session
+
+def http_get(url, **kwargs):
+    kwargs.setdefault('timeout', http_config['timeout'])
+    return get_http_session().get(url, **kwargs)
+
+def http_post(url, **kwargs):
+    kwargs.setdefault('timeout', http_config['timeout'])
+    return get_http_session().post(url, **kwargs)
+
 def remove_version_prefix(version):
     return re.sub(r'[^0-9\.\-rc]', '', version)
 
@@ -50,85 +119,277 @@ def release_to_tuple(name):
     name = remove_version_prefix(name)
     return tuple(int(x) for x in re.split('\\-rc|\\.', name, 0))
 
-def stream_gzip_decompress(stream):
-    dec = zlib.decompressobj(32 + zlib.MAX_WBITS)  # offset 32 to skip the header
+class XZRecompressor(object):
+    # Recompresses a file to .xz while it is being downloaded.
+    # The download thread hands chunks over through a bounded queue, a separate thread decompresses them,
+    # and the compression itself is spread over multiple threads in independent .xz blocks.
+
+    def __init__(self, destination, threads=2):
+        self.destination = destination
+        self.threads = threads
+        self.thread = None
+
+    def start(self, content_type, part_filename, offset):
+        # A resumed download that continues right where we are: keep going
+        if self.thread is not None and self.content_type == content_type and self.received == offset:
+            return
+
+        # Otherwise, discard whatever we have done so far and start over
+        self.stop()
+        self.content_type = content_type
+        self.received = 0
+        self.error = None
+        self.aborted = False
+        self.queue = queue.Queue(maxsize=16)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        # Any data that was downloaded during an earlier run has to be recompressed first
+        if offset:
+            with open(part_filename, 'rb') as f:
+                while self.received < offset:
+                    data = f.read(min(1048576, offset - self.received))
+
+                    if not data:
+                        raise OSError(f'{part_filename} is shorter than expected.')
+
+                    self.write(data)
+
+    def write(self, chunk):
+        if self.error is not None:
+            raise self.error
+
+        self.queue.put(chunk)
+        self.received += len(chunk)
+
+    def run(self):
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS) if 'application/x-gzip' in self.content_type else None # offset 32 to skip the header
+        finished = False
+
+        try:
+            with open(self.destination, 'wb') as f:
+                writer = f if 'application/x-xz' in self.content_type else compression.ParallelXZWriter(f, threads=self.threads)
+
+                try:
+                    while True:
+                        chunk = self.queue.get()
+
+                        if chunk is None:
+                            finished = True
+                            break
+
+                        if decompressor is not None:
+                            chunk = decompressor.decompress(chunk)
+
+                        if chunk:
+                            writer.write(chunk)
+
+                    if not self.aborted:
+                        if decompressor is not None:
+                            writer.write(decompressor.flush())
+
+                        if writer is not f:
+                            writer.close()
+                finally:
+                    if writer is not f:
+                        writer.abort()
+        except Exception as e:
+            self.error = e
+
+            # Drain the rest of the queue, so that the download thread never blocks
+            while not finished:
+                finished = self.queue.get() is None
+
+    def finish(self):
+        # Waits for the recompression to catch up with the completed download
+        self.aborted = False
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.aborted = True
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+def load_partial_download(link, part_filename, state_filename):
+    # Returns the state of a partial download of this link, or None if we have to start over
+    try:
+        with open(state_filename, 'r') as f:
+            state = json.load(f)
+    except:
+        state = None
+
+    # The state is saved after the data has been flushed, but neither of them are synced to the disk.
+    # After a crash, the partial download might be shorter than what we have recorded, so we have to start over.
+    if state and state.get('url') == link and state.get('validator') and os.path.exists(part_filename) and os.path.getsize(part_filename) >= state.get('received', 0):
+        # Anything after the last recorded byte is downloaded again
+        with open(part_filename, 'r+b') as f:
+            f.truncate(state['received'])
+
+        return state
+
+    for filename in (part_filename, state_filename):
+        if os.path.exists(filename):
+            os.remove(filename)
 
-    for chunk in stream:
-        rv = dec.decompress(chunk)
+    return None
 
-        if rv:
-            yield rv
+def save_partial_download(state, state_filename):
+    with open(state_filename, 'w') as f:
+        json.dump(state, f)
 
-    if dec.unused_data:
-        yield dec.flush()
+def get_download_validator(r):
+    # Weak ETags cannot be used to resume downloads
+    etag = r.headers.get('ETag', None)
 
-def stream_xz_compress(stream):
-    enc = lzma.LZMACompressor(lzma.FORMAT_XZ)
+    if etag and not etag.startswith('W/'):
+        return etag
 
-    for chunk in stream:
-        rv = enc.compress(chunk)
+    return r.headers.get('Last-Modified', None)
 
-        if rv:
-            yield rv
+def try_download_file(link, destination, expected_content_type, consumer=None):
+    part_filename = f'{destination}.part'
+    state_filename = f'{destination}.part.json'
+    state = load_partial_download(link, part_filename, state_filename)
+    headers = {}
 
-    yield enc.flush()
+    if state:
+        # Ask for the rest of the file, but only if it hasn't changed in the meantime.
+        # Otherwise, the server will send the whole file again.
+        headers['Range'] = f'bytes={state["received"]}-'
+        headers['If-Range'] = state['validator']
+
+    with http_get(link, headers=headers, stream=True) as r:
+        if r.status_code == 416:
+            # Our partial download makes no sense to the server, start over next time
+            load_partial_download(None, part_filename, state_filename)
 
-def download_file(link, destination, expected_content_type):
-    with requests.get(link, stream=True) as r:
         r.raise_for_status()
 
         content_type = r.headers.get('content-type', 'unset')
 
-        if content_type != expected_content_type:
+        if expected_content_type and content_type != expected_content_type:
             raise ContentTypeException(f'Expected content type {expected_content_type} but received {content_type}.')
 
-        with open(destination, 'wb') as f:
+        if state and r.status_code == 206 and r.headers.get('Content-Range', '').startswith(f'bytes {state["received"]}-'):
+            mode = 'ab'
+        else:
+            # The file has changed on the server (or we had nothing to resume), start over cleanly
+            state = {'url': link, 'validator': get_download_validator(r), 'received': 0}
+            mode = 'wb'
+
+        # The consumer gets to process the data while it is being downloaded
+        if consumer is not None:
+            consumer.start(content_type, part_filename, state['received'] if mode == 'ab' else 0)
+
+        start = time.monotonic()
+        received = 0
+
+        with open(part_filename, mode) as f:
             for chunk in r.iter_content(chunk_size=1048576):
-                if chunk:
-                    f.write(chunk)
+                if not chunk:
+                    continue
 
-            f.flush()
+                f.write(chunk)
+                received += len(chunk)
+                metrics.DOWNLOAD_BYTES.inc(len(chunk))
 
-def download_file_to_xz(link, destination):
-    with requests.get(link, stream=True) as r:
-        r.raise_for_status()
+                if consumer is not None:
+                    consumer.write(chunk)
 
-        content_type = r.headers.get('content-type', 'unset')
+                # Without a validator, we would not be able to tell if the file has changed, so we can't resume
+                if state['validator']:
+                    f.flush()
+                    state['received'] += len(chunk)
+                    save_partial_download(state, state_filename)
 
-        with open(destination, 'wb') as f:
-            iterator = r.iter_content(chunk_size=1048576)
+    elapsed = time.monotonic() - start
 
-            if 'application/x-gzip' in content_type:
-                iterator = stream_gzip_decompress(iterator)
+    if elapsed > 0:
+        metrics.DOWNLOAD_THROUGHPUT.observe(received / elapsed)
 
-            if 'application/x-xz' not in content_type:
-                iterator = stream_xz_compress(iterator)
+    os.replace(part_filename, destination)
 
-            with open(destination, 'wb') as f:
-                for chunk in iterator:
-                    if chunk:
-                        f.write(chunk)
+    if os.path.exists(state_filename):
+        os.remove(state_filename)
 
-                f.flush()
+    return content_type
 
-def get_all_hashes(filename):
-    md5 = hashlib.md5()
-    sha1 = hashlib.sha1()
-    sha256 = hashlib.sha256()
+def download_file(link, destination, expected_content_type=None, consumer=None):
+    # Downloads are kept in a .part file, alongside a small state file.
+    # If the connection drops, the download is resumed from where it left off,
+    # either right away or during a later run.
+    import requests
+
+    for attempt in range(http_config['retries'] + 1):
+        try:
+            with tracing.tracer.span('download file', url=link, attempt=attempt):
+                content_type = try_download_file(link, destination, expected_content_type, consumer)
+
+            metrics.DOWNLOADS.inc(result='success')
+            return content_type
+        except ContentTypeException:
+            metrics.DOWNLOADS.inc(result='failure')
+            raise
+        except (requests.RequestException, OSError):
+            if attempt >= http_config['retries']:
+                metrics.DOWNLOADS.inc(result='failure')
+                raise
 
-    with open(filename, 'rb') as file:
-        while True:
-            data = file.read(65536)
+            logging.info(f'Download of {link} was interrupted, resuming...')
 
-            if not data:
-                break
+            with tracing.tracer.span('retry delay', url=link):
+                time.sleep(attempt + 1)
 
-            md5.update(data)
-            sha1.update(data)
-            sha256.update(data)
+def download_file_to_xz(link, destination, download_filename, threads=2):
+    # The archive is recompressed while it is being downloaded.
+    # The original archive is still kept on disk until we're done, so that the download can be resumed.
+    recompressor = XZRecompressor(destination, threads)
+
+    try:
+        download_file(link, download_filename, consumer=recompressor)
+        recompressor.finish()
+    finally:
+        recompressor.stop()
 
-    return md5.hexdigest(), sha1.hexdigest(), sha256.hexdigest()
+    os.remove(download_filename)
 
-def split_list(a, n):
-    k, m = divmod(len(a), n)
-    return (a[i*k+min(i, m):(i+1)*k+min(i+1, m)] for i in range(n))
+def move_file(source, destination):
+    # Renames are atomic and don't touch the data at all, but they only work within the same filesystem
+    try:
+        os.replace(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    # Otherwise, share the data blocks with a reflink, and copy the file as a last resort.
+    # The file is written next to its destination first, so that it still appears atomically.
+    tmp_destination = f'{destination}.tmp'
+
+    try:
+        with open(source, 'rb') as src, open(tmp_destination, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                shutil.copyfileobj(src, dst, 1048576)
+
+        os.replace(tmp_destination, destination)
+    except:
+        if os.path.exists(tmp_destination):
+            os.remove(tmp_destination)
+
+        raise
+
+    os.remove(source)
+
+def get_all_hashes(filename):
+    return hashing.hash_file(filename)
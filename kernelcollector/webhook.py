@@ -1,15 +1,35 @@
-import logging, time
-import requests
+from . import utils
+import threading, logging, atexit, queue, time, os
 
-HEADERS = {'User-Agent': 'KernelCollector'}
+MESSAGE_LIMIT = 19980
 
 class WebhookEmitter(object):
 
-    def __init__(self, webhook):
+    def __init__(self, webhook, interval=2, max_attempts=5, max_backoff=60, flush_timeout=30):
         self.webhook = webhook
         self.queue = []
         self.embeds = []
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.flush_timeout = flush_timeout
         self.next_webhook = 0
+        self.deadline = None
+        self.outbox = None
+        self.sender = None
+        self.sender_pid = None
+        self.forward_queue = None
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        # The lock and the sender thread belong to this process, worker processes get their own
+        state = self.__dict__.copy()
+        state.update(lock=None, outbox=None, sender=None, sender_pid=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
 
     def set_webhook(self, webhook):
         self.webhook = webhook
@@ -20,40 +40,168 @@ class WebhookEmitter(object):
         if alert:
             message = '@everyone\n' + message
 
-        for msg in [message[x:x+19980] for x in range(0, len(message), 19980)]:
-            self.queue.append(msg)
+        with self.lock:
+            for msg in [message[x:x+MESSAGE_LIMIT] for x in range(0, len(message), MESSAGE_LIMIT)]:
+                self.queue.append(msg)
 
     def add_embed(self, embed):
-        self.embeds.append(embed)
+        with self.lock:
+            self.embeds.append(embed)
+
+    def forward_to(self, forward_queue):
+        # Used by worker processes: instead of being sent from the worker,
+        # messages are handed over to the emitter of the main process.
+        self.lock = threading.RLock()
+        self.queue = []
+        self.embeds = []
+        self.forward_queue = forward_queue
+
+    def receive(self, forward_queue):
+        # Collects the messages forwarded by worker processes until None is received,
+        # so that they are logged, batched and rate limited together with our own messages.
+        for kind, data in iter(forward_queue.get, None):
+            with self.lock:
+                if kind == 'content':
+                    self.queue.append(data)
+                else:
+                    self.embeds.append(data)
+
+                self.send_all()
+
+    def start_receiver(self, forward_queue):
+        receiver = threading.Thread(target=self.receive, args=(forward_queue,), daemon=True)
+        receiver.start()
+        return receiver
+
+    def wait(self, delay):
+        # Sleeps, but never past the deadline of the final flush.
+        # Returns False if we have run out of time.
+        if self.deadline is not None:
+            delay = min(delay, self.deadline - time.time())
+
+            if delay <= 0:
+                return False
+
+        if delay > 0:
+            time.sleep(delay)
+
+        return True
+
+    def get_retry_after(self, req):
+        # Discord tells us how long to wait when we're being rate limited
+        if req.status_code != 429:
+            return None
 
-    def try_post(self, *args, **kwargs):
         try:
-            req = requests.post(*args, **kwargs)
+            return float(req.headers['Retry-After'])
+        except:
+            pass
+
+        try:
+            return float(req.json()['retry_after'])
+        except:
+            return 1
 
+    def try_post(self, *args, **kwargs):
+        # Returns True if the request has been delivered.
+        # Failures are retried with an exponential backoff, but only a limited number of times.
+        for attempt in range(self.max_attempts):
             try:
-                req = req.json()
+                req = utils.http_post(*args, **kwargs)
+                retry_after = self.get_retry_after(req)
+
+                if retry_after is None:
+                    req.raise_for_status()
+                    return True
+
+                delay = retry_after + 0.1
             except:
-                return True
+                logging.info(f'Could not send webhook (attempt {attempt + 1}/{self.max_attempts})...')
+                delay = min(2 ** attempt, self.max_backoff)
 
-            if 'retry_after' in req:
-                time.sleep((req['retry_after'] / 1000) + 0.1)
-                return self.try_post(*args, **kwargs)
-        except:
-            print('Could not send request... trying again.')
-            time.sleep(1)
-            return self.try_post(*args, **kwargs)
+            if attempt + 1 < self.max_attempts and not self.wait(delay):
+                break
 
-    def send_webhook(self, data):
-        current_time = time.time()
+        logging.info('Giving up on sending webhook.')
+        return False
 
-        if self.next_webhook > current_time:
-            time.sleep(self.next_webhook - current_time)
+    def send_webhook(self, data):
+        if not self.wait(self.next_webhook - time.time()):
+            return False
 
-        result = self.try_post(self.webhook, headers=HEADERS, json=data)
-        self.next_webhook = time.time() + 2
+        result = self.try_post(self.webhook, json=data)
+        self.next_webhook = time.time() + self.interval
         return result
 
+    def get_outbox(self):
+        # The sender thread is started on demand, once per process
+        if self.sender_pid != os.getpid():
+            self.outbox = queue.Queue()
+            self.sender = threading.Thread(target=self.run_sender, daemon=True)
+            self.sender_pid = os.getpid()
+            self.sender.start()
+            atexit.register(self.close)
+
+        return self.outbox
+
+    def run_sender(self):
+        pending = []
+
+        while True:
+            item = pending.pop() if pending else self.outbox.get()
+
+            if item is None:
+                break
+
+            kind, data = item
+
+            # Batch up all messages that are already waiting, as long as they fit into one message
+            while kind == 'content':
+                try:
+                    item = self.outbox.get_nowait()
+                except queue.Empty:
+                    break
+
+                if item is None or item[0] != 'content' or len(data) + len(item[1]) + 1 > MESSAGE_LIMIT:
+                    pending.append(item)
+                    break
+
+                data += '\n' + item[1]
+
+            # Whatever is left after the deadline of the final flush is dropped
+            if self.deadline is not None and time.time() >= self.deadline:
+                continue
+
+            self.send_webhook({'content': data} if kind == 'content' else data)
+
+    def close(self):
+        # Gives the sender thread a limited amount of time to deliver everything that is left
+        if self.sender_pid != os.getpid() or not self.sender.is_alive():
+            return
+
+        self.deadline = time.time() + self.flush_timeout
+        self.outbox.put(None)
+        self.sender.join(self.flush_timeout)
+
+        # A new sender thread will be started if there is anything else to send
+        self.deadline = None
+        self.sender_pid = None
+
     def send_all(self):
+        with self.lock:
+            if self.forward_queue is not None:
+                self.forward_all()
+            else:
+                self.emit_all()
+
+    def forward_all(self):
+        while self.queue:
+            self.forward_queue.put(('content', self.queue.pop(0)))
+
+        while self.embeds:
+            self.forward_queue.put(('embed', self.embeds.pop(0)))
+
+    def emit_all(self):
         for item in self.queue:
             logging.info(item)
 
@@ -68,20 +216,11 @@ class WebhookEmitter(object):
             self.embeds = []
             return
 
-        while self.queue:
-            current_item = self.queue.pop(0)
-
-            while self.queue:
-                item = self.queue.pop(0)
+        # The messages are delivered in the background, so that a slow webhook never holds up the build
+        outbox = self.get_outbox()
 
-                if (len(item) + len(current_item)) > 19980:
-                    self.send_webhook({'content': current_item})
-                    current_item = item
-                else:
-                    current_item += '\n'
-                    current_item += item
-
-            self.send_webhook({'content': current_item})
+        while self.queue:
+            outbox.put(('content', self.queue.pop(0)))
 
         while self.embeds:
-            self.send_webhook(self.embeds.pop(0))
+            outbox.put(('embed', self.embeds.pop(0)))
@@ -0,0 +1,77 @@
+from kernelcollector.package_collector import PackageCollector, init_repack_worker, repack_package_worker
+from kernelcollector.package_list import PackageList
+from kernelcollector.package_distribution import PackageDistribution
+from kernelcollector.webhook import WebhookEmitter
+from kernelcollector import debfile, tracing
+import multiprocessing, tempfile, tarfile, unittest, shutil, io, os
+
+CONTROL = '\n'.join([
+    'Package: linux-image-unsigned-6.11.3-061103-generic', 'Version: 6.11.3-061103.202410101238', 'Architecture: amd64',
+    'Maintainer: Test <test@localhost>', 'Installed-Size: 1', 'Section: kernel', 'Priority: optional', 'Description: Test package', ''
+]).encode('utf-8')
+
+def make_tar_info(name, size=0):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    return info
+
+def make_deb(filename):
+    data = io.BytesIO()
+
+    with tarfile.open(fileobj=data, mode='w:gz', format=tarfile.GNU_FORMAT) as tar:
+        tar.addfile(make_tar_info('./boot/vmlinuz', 4), io.BytesIO(b'test'))
+
+    with open(filename, 'wb') as file:
+        deb = debfile.DebWriter(file)
+        deb.add_control_files({'control': [make_tar_info('./control'), CONTROL]})
+        deb.add_member_from_file('data.tar.gz', io.BytesIO(data.getvalue()), len(data.getvalue()))
+
+class RepackPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.logger = WebhookEmitter(None)
+        self.pkg_list = PackageList(self.logger, os.path.join(self.work_dir, 'repo'), 'ABCDEF', 'none')
+        self.pkg_list.add_distribution(PackageDistribution(self.logger, 'sid', ['amd64'], 'Test'))
+        self.pkg_list.clear_staging()
+        self.collector = PackageCollector(self.logger, ['amd64'], self.pkg_list)
+
+        # The collector has to survive being pickled even after its threads have been started
+        self.logger.get_outbox()
+
+    def tearDown(self):
+        self.logger.close()
+        tracing.tracer.enabled = False
+        tracing.tracer.events = []
+        shutil.rmtree(self.work_dir)
+
+    def test_repack_under_forkserver(self):
+        # Python 3.14 starts pool workers with forkserver by default, which pickles the initializer arguments
+        context = multiprocessing.get_context('forkserver')
+        deb_filename = os.path.join(self.work_dir, 'upstream.deb')
+        make_deb(deb_filename)
+
+        log_queue = context.Queue()
+        metrics_queue = context.Queue()
+        trace_queue = context.Queue()
+        tracing.tracer.enable()
+
+        with context.Pool(processes=1, initializer=init_repack_worker, initargs=(self.collector, log_queue, metrics_queue, trace_queue)) as pool:
+            receiver = tracing.tracer.start_receiver(trace_queue)
+            result = pool.apply(repack_package_worker, ('6.11.3', 'linux-current', 'linux-current-image-generic-amd64', [deb_filename]))
+            pool.close()
+            pool.join()
+
+        trace_queue.put(None)
+        receiver.join()
+
+        self.assertIsNotNone(result)
+        filename, control, hashes, contents = result
+        self.assertTrue(os.path.exists(filename))
+        self.assertIn('Package: linux-current-image-generic-amd64', control)
+        self.assertIn('boot/vmlinuz', contents)
+        self.assertIn('repack', [event['name'] for event in tracing.tracer.events])
+
+if __name__ == '__main__':
+    unittest.main()